@@ -3,41 +3,1718 @@
 # Fecha: 2025
 # Requiere: pip install requests beautifulsoup4 duckduckgo-search rich
 
+import ast
 import json
+import math
 import re
-import requests
-from duckduckgo_search import DDGS
+import hashlib
+import importlib
+import importlib.util
 from datetime import datetime
 import subprocess
+import codecs
+import time
 import os
 import sys
 import traceback
+import threading
+import queue
+import random
+import textwrap
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager, redirect_stdout
 from pathlib import Path
 
-# Opcional: para mejor output visual
-try:
-    from rich.console import Console
-    from rich.markdown import Markdown
-    from rich.panel import Panel
-    from rich.progress import Progress, SpinnerColumn, TextColumn
-    RICH_AVAILABLE = True
-    console = Console()
-except ImportError:
-    RICH_AVAILABLE = False
-    console = None
+class LazyModule:
+    """Importa un módulo la primera vez que se accede a uno de sus atributos
+    
+    Las consultas rápidas (calculator, get_time) no necesitan red, así que
+    no pagan el coste de importar requests y sus dependencias.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = LazyModule("requests")
+
+# Solo los usan el agente asíncrono, las cachés en disco y el planificador de
+# herramientas: importarlos al arrancar duplicaba el tiempo de `import agente_ia`
+asyncio = LazyModule("asyncio")
+futures = LazyModule("concurrent.futures")
+sqlite3 = LazyModule("sqlite3")
+inspect = LazyModule("inspect")
+
+# Opcional: para mejor output visual (la consola se crea al imprimir por primera vez)
+RICH_AVAILABLE = importlib.util.find_spec("rich") is not None
+
+# Opcional: cliente HTTP asíncrono para AsyncOpenSourceAgent (sin él se usan hilos)
+HTTPX_AVAILABLE = importlib.util.find_spec("httpx") is not None
+
+# Opcional: extracción del texto de las páginas en la búsqueda profunda (--deep-search).
+# Se comprueba con lxml_available() al activarla: el paquete puede estar instalado sin
+# su extensión compilada e importarlo al arrancar costaría más que todo el módulo
+
+# Opcional: índice vectorial del enrutador semántico (--semantic-router)
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+np = LazyModule("numpy")
+console = None
+
+def lxml_available():
+    """Si lxml.etree y lxml.html se pueden importar (no basta con que exista el paquete)"""
+    try:
+        import lxml.etree
+        import lxml.html
+    except ImportError:
+        return False
+    return True
+
+def get_console():
+    """Devuelve la consola de Rich, creándola en el primer uso (None sin Rich)"""
+    global console
+    if console is None and RICH_AVAILABLE:
+        from rich.console import Console
+        console = Console()
+    return console
+
+IMPORT_TIME_BUDGET_MS = 100  # Presupuesto para `import agente_ia` (medido con -X importtime)
+
+DEFAULT_OLLAMA_HOST = "http://127.0.0.1:11434"
+MODEL_CACHE_TTL = 300  # Segundos que se reutiliza en disco el inventario de modelos
+INTERNET_RECHECK_INTERVAL = 30  # Segundos antes de volver a probar una conexión caída
+DEFAULT_CONTEXT_LENGTH = 4096  # num_ctx que se pide a Ollama
+RESPONSE_TOKEN_RESERVE = 1024  # Tokens del contexto reservados para la respuesta
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Validez de una respuesta cacheada del modelo
+RESPONSE_CACHE_MAX_BYTES = 50 * 1024 * 1024  # Tamaño máximo de la caché de respuestas
+
+MAX_AGENT_STEPS = 3  # Iteraciones modelo → herramientas → observación por consulta
+OBSERVATION_CHAR_LIMIT = 2000  # Caracteres de cada resultado que se devuelven al modelo
+OBSERVATION_CHAR_LIMITS = {"web_search": 6000}  # Excepciones (la búsqueda profunda trae extractos)
+
+TOOL_MODES = ("text", "native", "auto")  # Protocolo de herramientas: texto USE_TOOL, JSON nativo o automático
+
+SYSTEM_PROMPT_RULES = """REGLAS IMPORTANTES:
+1. Proporciona respuestas DIRECTAS e INFORMATIVAS
+2. NO hagas preguntas innecesarias al usuario
+3. Usa las herramientas automáticamente cuando sean necesarias
+4. Presenta la información de forma clara y organizada
+5. Incluye detalles relevantes sin ser redundante"""
+
+# Herramientas integradas: (argumentos, descripción) para el system prompt
+TOOL_DESCRIPTIONS = {
+    "web_search": ("query", "Buscar información actualizada en internet"),
+    "calculator": ("expression", "Realizar cálculos matemáticos"),
+    "file_operations": ("operation, filename, content", "Manejar archivos"),
+    "python_code": ("code", "Ejecutar código Python"),
+    "get_time": ("", "Obtener información de tiempo"),
+    "system_info": ("", "Información del sistema"),
+    "weather": ("city", "Información del clima"),
+}
+
+# Planificación de herramientas pedidas por el modelo
+TOOL_WORKERS = 4  # Herramientas ejecutándose a la vez como máximo
+TOOL_TIMEOUT = 30  # Segundos por defecto antes de abandonar una herramienta (desde que empieza)
+TOOL_QUEUE_TIMEOUT = 60  # Segundos que una llamada puede esperar turno (permisos o la llamada anterior)
+TOOL_TIMEOUTS = {"web_search": 20, "weather": 15, "python_code": 10}
+TOOL_CONCURRENCY_LIMITS = {"web_search": 2, "weather": 4}
+TOOL_LATENCY_HISTORY = 50  # Latencias recientes guardadas por herramienta
+SERIAL_TOOLS = {"file_operations", "python_code"}  # Con efectos: se ejecutan en orden
+
+# Clientes de DuckDuckGo reutilizables (uno por búsqueda concurrente)
+SEARCH_POOL_SIZE = TOOL_CONCURRENCY_LIMITS["web_search"]
+SEARCH_REGION = "wt-wt"  # Región de DuckDuckGo (wt-wt = sin región, es-es, mx-es, us-en...)
+SEARCH_SAFESEARCH = "moderate"  # on, moderate u off
+SEARCH_RETRIES = 3  # Intentos ante un límite de peticiones
+SEARCH_BACKOFF = 1.0  # Segundos de la primera espera (se duplica en cada intento)
+
+# Caché de búsquedas: memoria (LRU) + SQLite
+SEARCH_CACHE_TTL = 3600  # Segundos en que un resultado se sirve como fresco
+SEARCH_CACHE_STALE = 24 * 3600  # Segundos extra en que se sirve caducado mientras se refresca
+SEARCH_CACHE_MEMORY = 256  # Búsquedas en el nivel en memoria
+SEARCH_CACHE_MAX_BYTES = 20 * 1024 * 1024  # Tamaño máximo del nivel en disco
+
+# Índice local de texto completo (SQLite FTS5) con lo que devuelven las búsquedas
+SEARCH_INDEX_MAX_BYTES = 100 * 1024 * 1024  # Tamaño máximo del texto indexado
+SEARCH_INDEX_MIN_HITS = 3  # Documentos locales necesarios para no ir a la red
+SEARCH_INDEX_PAGE_CHARS = 50000  # Caracteres que se indexan de cada página
+
+# Clima (wttr.in); la URL se puede apuntar a un servidor local con respuestas grabadas
+WEATHER_URL = os.environ.get("AGENTE_WEATHER_URL", "https://wttr.in")
+WEATHER_CACHE_TTL = 600  # Segundos que se reutiliza el clima de una ciudad
+WEATHER_TIMEOUT = 10  # Segundos por consulta
+WEATHER_WORKERS = TOOL_CONCURRENCY_LIMITS["weather"]  # Ciudades consultadas a la vez en un lote
+
+# Búsqueda profunda: descarga de las páginas de los resultados y extractos relevantes
+DEEP_SEARCH_PAGES = 3  # Resultados cuya página se descarga
+PAGE_FETCH_TIMEOUT = 8  # Segundos por página
+PAGE_MAX_BYTES = 1024 * 1024  # Se deja de leer una página al llegar a este tamaño
+PAGE_HOST_LIMIT = 2  # Descargas simultáneas contra un mismo servidor
+DEEP_SEARCH_CHUNK_CHARS = 700  # Tamaño aproximado de cada fragmento de texto
+DEEP_SEARCH_TOKEN_BUDGET = 1000  # Tokens de extractos que se entregan al modelo
+# Elementos que no forman parte del contenido principal de una página
+PAGE_NOISE_TAGS = ("script", "style", "noscript", "nav", "header", "footer", "aside", "form",
+                   "iframe", "svg", "button")
+PAGE_BLOCK_TAGS = ("p", "li", "h1", "h2", "h3", "h4", "pre", "blockquote", "td", "dd")
+
+# Enrutado directo a herramientas sin el modelo: {herramienta: {frase: peso}}.
+# Las frases se buscan como palabras completas; en caso de empate gana la
+# herramienta que aparece antes. 1.0 = señal clara, 0.6 = suficiente por sí
+# sola, 0.3 = solo cuenta junto a otras señales
+INTENT_KEYWORDS = {
+    "web_search": {
+        "busca": 1.0, "buscar": 1.0, "búscame": 1.0, "search": 1.0, "últimas noticias": 1.0,
+        "define": 1.0, "definición": 1.0, "noticias": 0.6, "actualiza": 0.6,
+        "información": 0.3, "último": 0.3, "última": 0.3, "find": 0.3, "what is": 0.3,
+        "qué es": 0.3, "que es": 0.3, "cómo está": 0.3,
+    },
+    "calculator": {
+        "calcula": 1.0, "calcular": 1.0, "calculate": 1.0, "cuánto es": 0.3, "cuanto es": 0.3,
+        "how much": 0.3, "suma": 0.3, "resta": 0.3, "multiplica": 0.3, "divide": 0.3, "math": 0.3,
+    },
+    "get_time": {
+        "qué hora es": 1.0, "que hora es": 1.0, "qué horas son": 1.0, "que horas son": 1.0,
+        "hora actual": 1.0, "fecha de hoy": 1.0, "fecha actual": 1.0, "qué día es hoy": 1.0,
+        "que dia es hoy": 1.0, "what time is it": 1.0, "qué hora": 0.3, "que hora": 0.3,
+        "hora": 0.3, "fecha": 0.3, "what time": 0.3, "time": 0.3, "date": 0.3,
+    },
+    "weather": {
+        "clima": 1.0, "weather": 1.0, "pronóstico": 1.0, "qué temperatura hace": 1.0,
+        "que temperatura hace": 1.0, "va a llover": 1.0, "llueve": 0.6, "soleado": 0.6,
+        "temperatura": 0.3, "lluvia": 0.3, "sol": 0.3,
+    },
+}
+# Una operación aritmética ("15 * 23", "(2+3)/4") solo suma como señal débil:
+# únicamente enruta junto a otra señal o si la consulta es solo la operación
+INTENT_EXPRESSION = r'[\d)]\s*[-+*/^%×÷]\s*[\d(]'
+INTENT_EXPRESSION_WEIGHT = 0.3
+INTENT_ONLY_EXPRESSION = re.compile(r'[\s\d.,()+\-*/^%×÷]+[=?]?')
+INTENT_ONLY_EXPRESSION_WEIGHT = 1.0
+# Fechas y teléfonos con guiones no son restas: "2025-01-15", "300-555-1234", "15/01/2025"
+INTENT_NOT_EXPRESSION = (r'(?<![\d.])(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{4}'
+                         r'|\(?\d{3}\)?[-.\s]\d{3}[-.\s]\d{4}|\d{3}-\d{4})(?![\d.])')
+INTENT_THRESHOLD = 0.6  # Puntuación mínima para usar la herramienta sin el modelo
+
+# Prefetch especulativo: si el enrutador duda, la herramienta de red se lanza
+# mientras el modelo genera y su resultado se usa si el modelo la pide
+SPECULATIVE_TOOLS = ("web_search", "weather")
+SPECULATION_THRESHOLD = 0.3  # Puntuación mínima (por debajo de INTENT_THRESHOLD) para especular
+SPECULATION_MATCH = 0.5  # Palabras en común (Jaccard) para aceptar los argumentos del modelo
+SPECULATION_WINDOW = 10  # Prefetches recientes que cuentan para el presupuesto
+SPECULATION_MAX_WASTED = 3  # Prefetches descartados en la ventana antes de dejar de especular
+
+# Enrutado semántico opcional: ejemplos etiquetados que se comparan por embeddings
+EMBED_MODEL = "nomic-embed-text"  # Modelo de embeddings de Ollama ("hash" = sin modelo)
+HASH_EMBED_DIM = 512  # Dimensión del embedding local por n-gramas
+SEMANTIC_THRESHOLD = 0.75  # Similitud coseno mínima para enrutar sin el modelo
+SEMANTIC_EXAMPLES = {
+    "calculator": [
+        "cuánto es 15 por 23", "calcula la raíz de 144", "suma 250 y 375", "what is 12 times 8",
+        "divide 1000 entre 7", "cuál es el 20% de 80",
+    ],
+    "get_time": [
+        "qué hora es", "qué día es hoy", "dime la fecha de hoy", "what time is it",
+        "en qué año estamos", "a qué fecha estamos",
+    ],
+    "weather": [
+        "qué tiempo hace en Madrid", "va a llover mañana", "clima en Bogotá", "how is the weather in London",
+        "hace frío afuera", "qué temperatura hay hoy",
+    ],
+    "web_search": [
+        "busca noticias sobre inteligencia artificial", "últimas noticias de tecnología",
+        "quién ganó el partido de ayer", "search for python tutorials", "información sobre el cambio climático",
+        "precio actual del bitcoin",
+    ],
+}
+
+# Extracción de argumentos para la ejecución directa (sin el modelo)
+SEARCH_COMMAND_WORDS = {
+    "busca", "buscar", "búscame", "buscame", "search", "find", "información", "informacion",
+    "noticias", "actualiza", "define", "definición", "definicion", "dime", "quiero", "saber",
+    "please", "por", "favor", "internet", "web", "google",
+}
+SEARCH_STOP_WORDS = {
+    "a", "al", "acerca", "de", "del", "el", "la", "las", "los", "lo", "un", "una", "unos", "unas",
+    "sobre", "en", "con", "para", "y", "o", "que", "qué", "es", "son", "me", "mi", "sus", "su",
+    "cómo", "como", "está", "esta", "cuál", "cual", "the", "of", "about", "on", "for", "what",
+    "is", "are", "me", "an", "and", "to",
+}
+
+# Números, operadores y operadores en palabras ("3 por 4", "10 dividido entre 2")
+MATH_TOKEN = re.compile(
+    r'(?P<num>\d{1,3}(?:\.\d{3})+(?:,\d+)?(?![\d.])|\d+(?:[.,]\d+)?)'
+    r'|(?P<op>[-+*/^%()×÷])'
+    r'|(?P<word>multiplicado\s+por|dividido\s+(?:entre|por)|divided\s+by|elevado\s+a|más|mas|menos|'
+    r'por|entre|plus|minus|times|x)(?!\w)'
+    r'|(?P<other>\w+|\S)'
+)
+MATH_WORDS = {
+    "más": "+", "mas": "+", "plus": "+", "menos": "-", "minus": "-", "por": "*", "times": "*",
+    "x": "*", "multiplicado por": "*", "entre": "/", "dividido entre": "/", "dividido por": "/",
+    "divided by": "/", "elevado a": "^", "×": "*", "÷": "/",
+}
+# "15% de 200" → (15*200/100); el % de la calculadora es el módulo
+MATH_PERCENT_OF = re.compile(r'(\d+(?:[.,]\d+)?)\s*%\s*(?:de|of)\s+(\d+(?:[.,]\d+)?)')
+MATH_NOT_EXPRESSION = re.compile(INTENT_NOT_EXPRESSION)
+MATH_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.operator, ast.unaryop)
+
+# Gazetteer local para detectar la ciudad sin red: {alias sin tildes: nombre}
+CITY_GAZETTEER = {
+    "madrid": "Madrid", "barcelona": "Barcelona", "valencia": "Valencia", "sevilla": "Sevilla",
+    "bilbao": "Bilbao", "malaga": "Málaga", "zaragoza": "Zaragoza", "granada": "Granada",
+    "bogota": "Bogotá", "medellin": "Medellín", "cali": "Cali", "barranquilla": "Barranquilla",
+    "cartagena": "Cartagena", "bucaramanga": "Bucaramanga", "pereira": "Pereira", "manizales": "Manizales",
+    "ciudad de mexico": "Ciudad de México", "cdmx": "Ciudad de México", "mexico df": "Ciudad de México",
+    "guadalajara": "Guadalajara", "monterrey": "Monterrey", "cancun": "Cancún", "puebla": "Puebla",
+    "buenos aires": "Buenos Aires", "cordoba": "Córdoba", "rosario": "Rosario", "mendoza": "Mendoza",
+    "santiago de chile": "Santiago de Chile", "santiago": "Santiago de Chile", "valparaiso": "Valparaíso",
+    "lima": "Lima", "cusco": "Cusco", "arequipa": "Arequipa", "quito": "Quito", "guayaquil": "Guayaquil",
+    "caracas": "Caracas", "maracaibo": "Maracaibo", "montevideo": "Montevideo", "asuncion": "Asunción",
+    "la paz": "La Paz", "santa cruz de la sierra": "Santa Cruz de la Sierra", "sucre": "Sucre",
+    "san jose": "San José", "panama": "Panamá", "san salvador": "San Salvador",
+    "tegucigalpa": "Tegucigalpa", "managua": "Managua", "ciudad de guatemala": "Ciudad de Guatemala",
+    "la habana": "La Habana", "habana": "La Habana", "santo domingo": "Santo Domingo", "san juan": "San Juan",
+    "nueva york": "New York", "new york": "New York", "los angeles": "Los Angeles", "miami": "Miami",
+    "chicago": "Chicago", "houston": "Houston", "san francisco": "San Francisco", "toronto": "Toronto",
+    "londres": "London", "london": "London", "paris": "Paris", "roma": "Rome", "rome": "Rome",
+    "berlin": "Berlin", "lisboa": "Lisbon", "lisbon": "Lisbon", "amsterdam": "Amsterdam",
+    "bruselas": "Brussels", "viena": "Vienna", "moscu": "Moscow", "estambul": "Istanbul",
+    "atenas": "Athens", "milan": "Milan", "munich": "Munich", "dublin": "Dublin",
+    "tokio": "Tokyo", "tokyo": "Tokyo", "pekin": "Beijing", "beijing": "Beijing", "shanghai": "Shanghai",
+    "seul": "Seoul", "nueva delhi": "New Delhi", "bombay": "Mumbai", "mumbai": "Mumbai",
+    "sidney": "Sydney", "sydney": "Sydney", "el cairo": "Cairo", "dubai": "Dubai",
+    "sao paulo": "São Paulo", "rio de janeiro": "Rio de Janeiro", "brasilia": "Brasília",
+}
+CITY_GAZETTEER_PATTERN = re.compile(
+    r'(?<!\w)(?:' + "|".join(r'\s+'.join(map(re.escape, alias.split()))
+                            for alias in sorted(CITY_GAZETTEER, key=len, reverse=True)) + r')(?!\w)'
+)
+# Respaldo si la ciudad no está en el gazetteer: "clima en Villa de Leyva"
+CITY_AFTER_PREPOSITION = re.compile(
+    r'\b(?:en|in|de|para|for)\s+([A-ZÁÉÍÓÚÑ][\w\-]*(?:\s+(?:de|del|la|las|los)?\s*[A-ZÁÉÍÓÚÑ][\w\-]*)*)'
+)
+
+# Inventario de modelos por servidor, memoizado durante la vida del proceso
+_model_inventory = {}
+
+def strip_accents(text):
+    """Quita tildes y diacríticos ("Bogotá" → "Bogota")"""
+    return "".join(c for c in unicodedata.normalize("NFD", text) if not unicodedata.combining(c))
+
+# Palabras vacías sin tildes para normalizar las claves de la caché de búsquedas
+SEARCH_CACHE_STOP_WORDS = {strip_accents(word) for word in SEARCH_STOP_WORDS}
+
+def is_loopback_url(url):
+    """Si la URL apunta a esta máquina (localhost o una IP de loopback)"""
+    import ipaddress
+    from urllib.parse import urlsplit
+    
+    host = urlsplit(url).hostname or ""
+    if host == "localhost" or host.endswith(".localhost"):
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def format_size(num_bytes):
+    """Convierte bytes a un tamaño legible (como lo muestra `ollama list`)"""
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1000
+    return f"{size:.1f} TB"
+
+def estimate_tokens(text):
+    """Estimación rápida de tokens (~4 caracteres por token) sin tokenizador"""
+    return len(text) // 4 + 1
+
+class ConversationWindow:
+    def __init__(self, context_length=DEFAULT_CONTEXT_LENGTH, keep_recent=6, summary_tokens=256):
+        """
+        Ventana de conversación limitada por tokens para el modo chat
+        
+        Los turnos recientes se envían literalmente; los más antiguos se
+        condensan en una línea de resumen cada uno y, cuando el resumen
+        supera su presupuesto, las líneas más viejas se descartan.
+        
+        Args:
+            context_length: Tamaño de contexto del modelo (num_ctx)
+            keep_recent: Máximo de turnos que se conservan literalmente
+            summary_tokens: Presupuesto de tokens para el resumen de turnos antiguos
+        """
+        self.context_length = context_length
+        self.keep_recent = keep_recent
+        self.summary_tokens = summary_tokens
+        self.turns = []  # (usuario, asistente, tokens estimados)
+        self.summary_lines = []
+        
+        # Vector `context` de /api/generate: la caché KV de Ollama para esta sesión
+        self.kv_context = None
+        self.kv_key = None
+    
+    @property
+    def history_budget(self):
+        """Tokens que pueden ocupar los turnos literales en el prompt"""
+        return (self.context_length - RESPONSE_TOKEN_RESERVE) // 2
+    
+    def add_turn(self, user, assistant):
+        """Agrega un turno completo y compacta los más antiguos si hace falta"""
+        self.turns.append((user, assistant, estimate_tokens(user) + estimate_tokens(assistant)))
+        
+        while len(self.turns) > 1 and (len(self.turns) > self.keep_recent or
+                                       sum(t[2] for t in self.turns) > self.history_budget):
+            old_user, old_assistant, _ = self.turns.pop(0)
+            self._summarize(old_user, old_assistant)
+    
+    def _summarize(self, user, assistant):
+        """Resume un turno en una línea (extractivo, sin llamar al modelo)"""
+        self.summary_lines.append(
+            f"- Usuario: {textwrap.shorten(user, 120, placeholder='…')} | "
+            f"Agente: {textwrap.shorten(assistant, 200, placeholder='…')}"
+        )
+        while len(self.summary_lines) > 1 and estimate_tokens("\n".join(self.summary_lines)) > self.summary_tokens:
+            self.summary_lines.pop(0)
+    
+    def build_messages(self, system_prompt, user_query):
+        """Construye los mensajes de /api/chat respetando el tamaño de contexto"""
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        
+        budget = (self.context_length - RESPONSE_TOKEN_RESERVE
+                  - estimate_tokens(system_prompt or "") - estimate_tokens(user_query))
+        
+        if self.summary_lines:
+            # Mensaje aparte para no alterar el prefijo del system prompt principal
+            summary = "RESUMEN DE LA CONVERSACIÓN ANTERIOR:\n" + "\n".join(self.summary_lines)
+            if estimate_tokens(summary) < budget:
+                messages.append({"role": "system", "content": summary})
+                budget -= estimate_tokens(summary)
+        
+        # Los turnos más recientes tienen prioridad si no caben todos
+        selected = []
+        for user, assistant, tokens in reversed(self.turns):
+            if tokens > budget:
+                break
+            budget -= tokens
+            selected.append((user, assistant))
+        
+        for user, assistant in reversed(selected):
+            messages.append({"role": "user", "content": user})
+            messages.append({"role": "assistant", "content": assistant})
+        
+        messages.append({"role": "user", "content": user_query})
+        return messages
+    
+    @staticmethod
+    def context_key(model_name, system_prompt):
+        """Identifica el prefijo al que pertenece un vector de contexto"""
+        return hashlib.sha1(f"{model_name}\0{system_prompt or ''}".encode('utf-8')).hexdigest()
+    
+    def reusable_context(self, key, prompt):
+        """Devuelve el contexto guardado si sigue siendo válido para este prompt
+        
+        Se invalida si cambió el modelo o el system prompt, o si el nuevo
+        turno ya no cabe en el contexto del modelo.
+        """
+        if self.kv_context is None:
+            return None
+        if self.kv_key != key or (len(self.kv_context) + estimate_tokens(prompt)
+                                  > self.context_length - RESPONSE_TOKEN_RESERVE):
+            self.kv_context = None
+            self.kv_key = None
+            return None
+        return self.kv_context
+    
+    def store_context(self, key, context):
+        """Guarda el contexto devuelto por Ollama para el siguiente turno"""
+        self.kv_context = context or None
+        self.kv_key = key if context else None
+    
+    @staticmethod
+    def render_transcript(messages, system_prompt=None):
+        """Convierte mensajes de chat en un prompt de texto (omite el system prompt principal)"""
+        messages = [m for m in messages if not (m['role'] == 'system' and m['content'] == system_prompt)]
+        if len(messages) == 1:
+            return messages[0]['content']
+        
+        labels = {"system": "", "user": "Usuario: ", "assistant": "Asistente: "}
+        return "\n\n".join(f"{labels.get(m['role'], '')}{m['content']}" for m in messages)
+    
+    def transcript_prompt(self, user_query):
+        """Prompt de texto con la conversación previa, para sembrar un contexto nuevo"""
+        return self.render_transcript(self.build_messages(None, user_query))
+    
+    def clear(self):
+        """Olvida todos los turnos, el resumen y el contexto de Ollama"""
+        self.turns.clear()
+        self.summary_lines.clear()
+        self.kv_context = None
+        self.kv_key = None
+
+class ToolResult:
+    """Resultado estructurado de una herramienta que se convierte en texto solo al mostrarlo
+    
+    `data` viaja tal cual hacia quien lo necesite (salida JSON, interfaz
+    web) sin volver a parsear el texto con emojis; `render(data)` produce
+    los fragmentos del texto, que se unen una sola vez en el primer str().
+    """
+    __slots__ = ("tool", "data", "ok", "_render", "_text")
+    
+    def __init__(self, tool, data, render, ok=True):
+        self.tool = tool
+        self.data = data
+        self.ok = ok
+        self._render = render
+        self._text = None
+    
+    def __str__(self):
+        if self._text is None:
+            parts = self._render(self.data)
+            self._text = parts if isinstance(parts, str) else "".join(map(str, parts))
+        return self._text
+    
+    def __rich__(self):
+        return str(self)
+    
+    def to_dict(self):
+        return {"tool": self.tool, "ok": self.ok, "data": self.data, "text": str(self)}
+
+class AgentResponse:
+    """Respuesta del modelo más los resultados de las herramientas que pidió, renderizada una vez"""
+    __slots__ = ("response", "tool_results", "_text")
+    
+    def __init__(self, response, tool_results=()):
+        self.response = response
+        self.tool_results = list(tool_results)
+        self._text = None
+    
+    def __str__(self):
+        if self._text is None:
+            parts = [self.response]
+            if self.tool_results:
+                parts.append("\n\n" + "="*50 + "\n🔧 HERRAMIENTAS EJECUTADAS:\n" + "="*50)
+                for tool_result in self.tool_results:
+                    parts.append("\n\n")
+                    parts.append(str(tool_result))
+            self._text = "".join(parts)
+        return self._text
+    
+    def __rich__(self):
+        return str(self)
+    
+    def to_dict(self):
+        return {"response": self.response, "tools": [result_to_dict(r) for r in self.tool_results],
+                "text": str(self)}
+
+def result_to_dict(result):
+    """Forma JSON de cualquier resultado (los errores y mensajes simples son texto)"""
+    if hasattr(result, "to_dict"):
+        return result.to_dict()
+    return {"text": str(result)}
+
+# Inicio de una llamada a herramienta: USE_TOOL/TOOL/CALL/USAR: nombre(
+TOOL_CALL_START = re.compile(r'(?<!\w)(?:USE_TOOL|TOOL|CALL|USAR):\s*(\w+)\(', re.IGNORECASE)
+TOOL_CALL_LOOKBACK = 64  # Caracteres que se re-examinan por si un marcador llega partido
+QUOTE_OPENERS = "([{,=:"  # Tras estos caracteres una comilla abre un literal; en otro sitio es un apóstrofo
+
+class ToolCall(tuple):
+    """Llamada a herramienta: la tupla (nombre, argumentos en texto) de siempre, con nombres"""
+    __slots__ = ()
+    
+    def __new__(cls, name, args):
+        return super().__new__(cls, (name, args))
+    
+    @property
+    def name(self):
+        return self[0]
+    
+    @property
+    def args(self):
+        return self[1]
+
+class ToolCallScanner:
+    def __init__(self):
+        """
+        Detector incremental de llamadas a herramientas en el texto del modelo
+        
+        Recorre el texto una sola vez: una expresión precompilada localiza
+        el marcador y un escáner de caracteres busca el paréntesis de
+        cierre respetando paréntesis anidados, comillas y escapes (una
+        comilla en mitad de una palabra, como en "Python's", es un
+        apóstrofo y no abre un literal). Se puede
+        alimentar token a token (`feed`) para detectar llamadas mientras el
+        modelo todavía está generando.
+        """
+        self._buffer = ""
+        self._search_pos = 0
+        self._call = None  # Nombre de la herramienta de la llamada en curso
+        self._pos = 0
+        self._depth = 0
+        self._quote = None
+        self._escape = False
+        self._last = "("  # Último carácter visible fuera de comillas
+    
+    def feed(self, text):
+        """Agrega texto y devuelve las llamadas que quedaron completas"""
+        self._buffer += text
+        completed = []
+        
+        while True:
+            if self._call is None:
+                match = TOOL_CALL_START.search(self._buffer, self._search_pos)
+                if not match:
+                    # Conservar solo la cola por si el marcador está partido entre fragmentos
+                    keep_from = max(0, len(self._buffer) - TOOL_CALL_LOOKBACK)
+                    self._buffer = self._buffer[keep_from:]
+                    self._search_pos = max(0, self._search_pos - keep_from)
+                    return completed
+                
+                # El texto anterior ya no hace falta: los argumentos empiezan en 0
+                self._buffer = self._buffer[match.end():]
+                self._call = match.group(1)
+                self._pos = 0
+                self._depth, self._quote, self._escape, self._last = 1, None, False, "("
+            
+            call = self._scan()
+            if call is None:
+                return completed
+            completed.append(call)
+    
+    def _scan(self):
+        """Avanza sobre los argumentos de la llamada en curso; devuelve la llamada al cerrarla"""
+        buffer, pos = self._buffer, self._pos
+        
+        while pos < len(buffer):
+            char = buffer[pos]
+            if self._quote:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == self._quote:
+                    self._quote = None
+                pos += 1
+                continue
+            if char in "\"'" and self._last in QUOTE_OPENERS:
+                self._quote = char
+            elif char in "([{":
+                self._depth += 1
+            elif char in ")]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    call = ToolCall(self._call, buffer[:pos])
+                    
+                    self._call = None
+                    self._buffer = buffer[pos + 1:]
+                    self._search_pos = 0
+                    return call
+            if not char.isspace():
+                self._last = char
+            pos += 1
+        
+        self._pos = pos
+        return None
+
+def parse_tool_calls(text):
+    """Extrae todas las llamadas a herramientas de un texto completo"""
+    return ToolCallScanner().feed(text)
+
+def decode_tool_args(args):
+    """Convierte el texto de los argumentos en (posicionales, nombrados)
+    
+    Los argumentos se analizan una sola vez como los de una llamada de
+    Python: cada literal se decodifica con `ast.literal_eval` (comillas,
+    números, listas...) y lo que no es un literal (`15 * 23`, una palabra
+    sin comillas) se pasa como texto. Si no es sintaxis válida, todo el
+    texto es un único argumento.
+    """
+    args = args.strip()
+    if not args:
+        return [], {}
+    
+    source = f"f({args})"
+    try:
+        call = ast.parse(source, mode="eval").body
+    except (SyntaxError, ValueError, MemoryError, RecursionError):
+        return [args.strip("'\"")], {}
+    
+    def value(node):
+        try:
+            return ast.literal_eval(node)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return ast.get_source_segment(source, node)
+    
+    positional = [value(node) for node in call.args]
+    keywords = {kw.arg: value(kw.value) for kw in call.keywords if kw.arg}
+    return positional, keywords
+
+class IntentRouter:
+    def __init__(self, keywords=None, threshold=INTENT_THRESHOLD):
+        """
+        Enrutador determinista de consultas obvias a herramientas
+        
+        Todas las frases se compilan en una sola expresión regular con
+        límites de palabra, así que la consulta se recorre una vez: "sol"
+        ya no coincide con "solución" ni un guion manda la consulta a la
+        calculadora. Cada coincidencia suma su peso a su herramienta y
+        solo se enruta si la mejor puntuación alcanza el umbral. Las
+        fechas y teléfonos con guiones no cuentan como operaciones.
+        
+        Args:
+            keywords: {herramienta: {frase: peso}} (por defecto INTENT_KEYWORDS)
+            threshold: Puntuación mínima para enrutar sin el modelo
+        """
+        self.keywords = INTENT_KEYWORDS if keywords is None else keywords
+        self.threshold = threshold
+        self._weights = {}
+        for tool_name, phrases in self.keywords.items():
+            for phrase, weight in phrases.items():
+                self._weights[phrase.lower()] = (tool_name, weight)
+        
+        # Las frases más largas primero: "qué hora" gana a "hora"
+        phrases = sorted(self._weights, key=len, reverse=True)
+        alternatives = "|".join(r'\s+'.join(map(re.escape, phrase.split())) for phrase in phrases)
+        self._pattern = re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)'
+                                   rf'|(?P<skip>{INTENT_NOT_EXPRESSION})|(?P<expr>{INTENT_EXPRESSION})')
+    
+    def scores(self, query):
+        """Puntuación de cada herramienta para la consulta"""
+        scores = dict.fromkeys(self.keywords, 0.0)
+        expressions = 0
+        for match in self._pattern.finditer(query.lower()):
+            if match.group("skip"):
+                continue
+            if match.group("expr"):
+                expressions += 1
+                scores["calculator"] = scores.get("calculator", 0.0) + INTENT_EXPRESSION_WEIGHT
+            else:
+                tool_name, weight = self._weights[" ".join(match.group().split())]
+                scores[tool_name] += weight
+        if expressions and INTENT_ONLY_EXPRESSION.fullmatch(query.strip()):
+            scores["calculator"] = max(scores["calculator"], INTENT_ONLY_EXPRESSION_WEIGHT)
+        return scores
+    
+    def route(self, query):
+        """Herramienta con mayor puntuación o None si ninguna llega al umbral"""
+        scores = self.scores(query)
+        best = max(scores, key=scores.get, default=None)
+        if best is None or scores[best] < self.threshold:
+            return None
+        return best
+
+def hash_embeddings(texts, dim=HASH_EMBED_DIM):
+    """Embeddings locales por n-gramas de caracteres (sin modelo ni red)
+    
+    Sustituto del modelo de embeddings: no entiende sinónimos, pero
+    consultas con las mismas palabras quedan cerca.
+    """
+    vectors = []
+    for text in texts:
+        vector = [0.0] * dim
+        for word in strip_accents(text.lower()).split():
+            word = f" {word} "
+            for i in range(len(word) - 2):
+                digest = hashlib.md5(word[i:i + 3].encode()).digest()
+                vector[int.from_bytes(digest[:4], "little") % dim] += 1.0 if digest[4] & 1 else -1.0
+        vectors.append(vector)
+    return vectors
+
+class SemanticRouter:
+    def __init__(self, embed, index_path, model=EMBED_MODEL, examples=None, threshold=SEMANTIC_THRESHOLD):
+        """
+        Enrutador por vecino más cercano sobre consultas de ejemplo
+        
+        Los ejemplos de cada herramienta se convierten en una matriz NumPy
+        de vectores normalizados que se guarda en disco (.npz) y solo se
+        recalcula si cambian el modelo o los ejemplos. Enrutar cuesta un
+        embedding y un producto matriz-vector.
+        
+        Args:
+            embed: Función lista de textos → lista de vectores
+            index_path: Archivo .npz del índice
+            model: Nombre del modelo de embeddings (forma parte de la huella del índice)
+            examples: {herramienta: [consultas de ejemplo]} (por defecto SEMANTIC_EXAMPLES)
+            threshold: Similitud coseno mínima para enrutar
+        """
+        self.embed = embed
+        self.index_path = Path(index_path)
+        self.model = model
+        self.examples = SEMANTIC_EXAMPLES if examples is None else examples
+        self.threshold = threshold
+        self.matrix = None
+        self.labels = None
+        self.last_ms = None  # Duración de la última decisión
+        self._lock = threading.Lock()
+    
+    def fingerprint(self):
+        data = json.dumps([self.model, self.examples], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(data.encode()).hexdigest()
+    
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+    
+    def load(self):
+        """Carga el índice de disco o lo construye (un único lote de embeddings)"""
+        with self._lock:
+            if self.matrix is not None:
+                return
+            fingerprint = self.fingerprint()
+            try:
+                with np.load(self.index_path) as data:
+                    if str(data["fingerprint"]) == fingerprint:
+                        self.matrix, self.labels = data["matrix"], [str(label) for label in data["labels"]]
+                        return
+            except (OSError, KeyError, ValueError):
+                pass
+            
+            texts, labels = [], []
+            for tool_name, queries in self.examples.items():
+                texts.extend(queries)
+                labels.extend([tool_name] * len(queries))
+            matrix = self._normalize(np.asarray(self.embed(texts), dtype=np.float32))
+            
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.index_path, "wb") as f:
+                np.savez(f, matrix=matrix, labels=np.asarray(labels), fingerprint=np.asarray(fingerprint))
+            self.matrix, self.labels = matrix, labels
+    
+    def route(self, query):
+        """Herramienta del ejemplo más parecido o None si no supera el umbral"""
+        self.load()
+        started = time.perf_counter()
+        vector = self._normalize(np.asarray(self.embed([query])[0], dtype=np.float32))
+        similarities = self.matrix @ vector
+        best = int(similarities.argmax())
+        self.last_ms = (time.perf_counter() - started) * 1000
+        return self.labels[best] if similarities[best] >= self.threshold else None
+
+class ToolScheduler:
+    def __init__(self, max_workers=TOOL_WORKERS, limits=None, timeouts=None,
+                 default_timeout=TOOL_TIMEOUT, serial_tools=None, queue_timeout=TOOL_QUEUE_TIMEOUT):
+        """
+        Ejecuta llamadas a herramientas en paralelo con límites y timeouts
+        
+        Cada llamada corre en un hilo daemon (una herramienta colgada no
+        impide que el proceso termine). Hay un límite global de hilos
+        activos y otro por herramienta. Las herramientas con efectos
+        (`serial_tools`) esperan a la llamada anterior del mismo grupo.
+        
+        El timeout de una llamada cuenta desde que obtiene sus permisos; la
+        espera en cola tiene su propio límite (`queue_timeout`) y se
+        informa aparte. Una llamada que supera su plazo se abandona:
+        devuelve su hueco global para no bloquear a las demás herramientas
+        y su hilo sigue hasta terminar, contado en `abandoned`; el permiso
+        de su herramienta no se devuelve hasta entonces.
+        
+        Args:
+            max_workers: Herramientas ejecutándose a la vez como máximo
+            limits: {herramienta: concurrencia máxima}
+            timeouts: {herramienta: segundos} (el resto usa `default_timeout`)
+            default_timeout: Timeout por defecto en segundos
+            serial_tools: Herramientas que deben ejecutarse en orden entre sí
+            queue_timeout: Segundos que una llamada puede esperar su turno
+        """
+        self.timeouts = TOOL_TIMEOUTS if timeouts is None else timeouts
+        self.default_timeout = default_timeout
+        self.queue_timeout = queue_timeout
+        self.serial_tools = SERIAL_TOOLS if serial_tools is None else serial_tools
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._limits = {name: threading.BoundedSemaphore(n)
+                        for name, n in (TOOL_CONCURRENCY_LIMITS if limits is None else limits).items()}
+        self._serial_tail = None
+        self._serial_lock = threading.Lock()
+        self.latencies = {}  # {herramienta: deque de (ms de ejecución, ms en cola) recientes}
+        self.abandoned = {}  # {herramienta: hilos que siguen corriendo tras su timeout}
+        self._abandoned_lock = threading.Lock()
+    
+    def timeout_for(self, tool_name):
+        return self.timeouts.get(tool_name, self.default_timeout)
+    
+    def record_latency(self, tool_name, elapsed_ms, waited_ms=0):
+        history = self.latencies.setdefault(tool_name, deque(maxlen=TOOL_LATENCY_HISTORY))
+        history.append((elapsed_ms, waited_ms))
+    
+    def latency_stats(self):
+        """{herramienta: {'calls', 'avg_ms', 'max_ms', 'avg_wait_ms'}} de las llamadas recientes"""
+        stats = {}
+        for tool_name, history in list(self.latencies.items()):
+            if history:
+                elapsed, waited = zip(*history)
+                stats[tool_name] = {'calls': len(history),
+                                    'avg_ms': round(sum(elapsed) / len(elapsed)),
+                                    'max_ms': max(elapsed),
+                                    'avg_wait_ms': round(sum(waited) / len(waited))}
+        return stats
+    
+    def submit(self, tool_name, func, *args):
+        """Lanza una llamada y devuelve (Future, límite para obtener turno en time.monotonic())
+        
+        `future.admitted` se resuelve con el plazo de ejecución en cuanto la
+        llamada obtiene sus permisos (o con None si se canceló antes).
+        """
+        future = futures.Future()
+        future.admitted = futures.Future()
+        timeout = self.timeout_for(tool_name)
+        queued_at = time.monotonic()
+        after = None
+        
+        if tool_name in self.serial_tools:
+            with self._serial_lock:
+                after, self._serial_tail = self._serial_tail, future
+        
+        def worker():
+            if after is not None:
+                # Una llamada en serie espera a la anterior (como mucho hasta su plazo)
+                try:
+                    after_deadline = after.admitted.result()
+                    if after_deadline is not None:
+                        after.result(timeout=max(0.0, after_deadline - time.monotonic()))
+                except BaseException:
+                    pass
+            limit = self._limits.get(tool_name)
+            self._slots.acquire()
+            if limit:
+                limit.acquire()
+            released = []
+            release_lock = threading.Lock()
+            
+            def release(abandon=False):
+                # Al vencer el plazo se libera el hueco global para no bloquear a las
+                # demás herramientas; el permiso propio se conserva hasta que el hilo
+                # termine, así la herramienta nunca supera su límite de concurrencia
+                with release_lock:
+                    if released:
+                        if not abandon and released[0]:
+                            self._count_abandoned(tool_name, -1)
+                            if limit:
+                                limit.release()
+                        return
+                    released.append(abandon)
+                if abandon:
+                    self._count_abandoned(tool_name, 1)
+                elif limit:
+                    limit.release()
+                self._slots.release()
+            
+            # El plazo empieza ahora, con los permisos ya obtenidos
+            watchdog = threading.Timer(timeout, release, (True,))
+            watchdog.daemon = True
+            try:
+                if not future.set_running_or_notify_cancel():
+                    future.admitted.set_result(None)
+                    return
+                waited_ms = round((time.monotonic() - queued_at) * 1000)
+                future.admitted.set_result(time.monotonic() + timeout)
+                watchdog.start()
+                started = time.perf_counter()
+                try:
+                    result = func(*args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                finally:
+                    # La ejecución y la espera en cola se miden por separado
+                    self.record_latency(tool_name, round((time.perf_counter() - started) * 1000), waited_ms)
+            finally:
+                watchdog.cancel()
+                release()
+        
+        threading.Thread(target=worker, name=f"tool-{tool_name}", daemon=True).start()
+        return future, queued_at + self.queue_timeout
+    
+    def _count_abandoned(self, tool_name, delta):
+        with self._abandoned_lock:
+            count = self.abandoned.get(tool_name, 0) + delta
+            if count:
+                self.abandoned[tool_name] = count
+            else:
+                self.abandoned.pop(tool_name, None)
+    
+    def _outcome(self, tool_name, future, status):
+        """Resultado de una llamada o el mensaje de error correspondiente"""
+        if status == "queued":
+            future.cancel()
+            return f"⏱️ En cola: {tool_name} no obtuvo turno en {self.queue_timeout} s"
+        if status == "timeout":
+            return f"⏱️ Timeout: {tool_name} no respondió en {self.timeout_for(tool_name)} s"
+        try:
+            return future.result()
+        except Exception as e:
+            return f"❌ Error ejecutando {tool_name}: {str(e)}"
+    
+    def map(self, calls, started=None):
+        """Ejecuta [(herramienta, función, args), ...] y devuelve los resultados en el mismo orden
+        
+        `started` permite pasar, en la misma posición, lo que devolvió
+        `submit` para llamadas ya lanzadas (por ejemplo, detectadas durante
+        el streaming).
+        """
+        started = started or [None] * len(calls)
+        submitted = [(tool_name, *(early or self.submit(tool_name, func, *args)))
+                     for (tool_name, func, args), early in zip(calls, started)]
+        
+        results = []
+        for tool_name, future, queue_deadline in submitted:
+            try:
+                deadline = future.admitted.result(timeout=max(0.0, queue_deadline - time.monotonic()))
+            except futures.TimeoutError:
+                status = "queued"
+            else:
+                status = "done"
+                if deadline is not None:
+                    try:
+                        future.result(timeout=max(0.0, deadline - time.monotonic()))
+                    except futures.TimeoutError:
+                        status = "timeout"
+                    except Exception:
+                        pass
+            results.append(self._outcome(tool_name, future, status))
+        return results
+    
+    async def amap(self, calls, started=None):
+        """Versión asíncrona de `map` que no bloquea el bucle de eventos"""
+        started = started or [None] * len(calls)
+        submitted = [(tool_name, *(early or self.submit(tool_name, func, *args)))
+                     for (tool_name, func, args), early in zip(calls, started)]
+        
+        async def wait_one(tool_name, future, queue_deadline):
+            try:
+                deadline = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future.admitted)),
+                                                  max(0.0, queue_deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return self._outcome(tool_name, future, "queued")
+            status = "done"
+            if deadline is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                                           max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    status = "timeout"
+                except Exception:
+                    pass
+            return self._outcome(tool_name, future, status)
+        
+        return await asyncio.gather(*(wait_one(*item) for item in submitted))
+
+class ResponseCache:
+    def __init__(self, path, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        """
+        Caché persistente de respuestas del modelo en SQLite
+        
+        Las entradas caducan tras `ttl` segundos y, si el total supera
+        `max_bytes`, se eliminan las menos usadas recientemente (LRU).
+        
+        Args:
+            path: Archivo SQLite de la caché
+            ttl: Segundos de validez de cada respuesta
+            max_bytes: Tamaño máximo de las respuestas almacenadas
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed);
+        """)
+    
+    @staticmethod
+    def make_key(model, system_prompt, prompt, options):
+        """Clave de la caché a partir de todo lo que determina la respuesta"""
+        payload = json.dumps([model, system_prompt, prompt, options], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """Devuelve la respuesta cacheada o None si no existe o caducó"""
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+    
+    def get_entry(self, key):
+        """Devuelve (respuesta, instante de creación) o None si no existe o caducó"""
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return row
+    
+    def put(self, key, response):
+        """Guarda una respuesta y aplica la expulsión por tamaño"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                             (key, response, len(response.encode('utf-8')), now, now))
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Recorrer de la menos a la más usada hasta volver bajo el límite
+                excess, evict = total - self.max_bytes, []
+                for old_key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if excess <= 0:
+                        break
+                    evict.append((old_key,))
+                    excess -= size
+                self._db.executemany("DELETE FROM responses WHERE key = ?", evict)
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class SearchCache:
+    def __init__(self, path, ttl=SEARCH_CACHE_TTL, stale=SEARCH_CACHE_STALE,
+                 memory_entries=SEARCH_CACHE_MEMORY, max_bytes=SEARCH_CACHE_MAX_BYTES):
+        """
+        Caché de resultados de búsqueda en dos niveles
+        
+        Un LRU en memoria responde las búsquedas repetidas sin tocar disco;
+        debajo, una ResponseCache en SQLite conserva los resultados entre
+        sesiones. Durante `ttl` segundos un resultado es fresco; durante los
+        `stale` siguientes se sirve igualmente pero el llamador debe
+        refrescarlo en segundo plano (stale-while-revalidate). El archivo
+        SQLite se abre en la primera búsqueda, no al crear el agente.
+        
+        Args:
+            path: Archivo SQLite del nivel en disco
+            ttl: Segundos en que un resultado es fresco
+            stale: Segundos adicionales en que se sirve caducado
+            memory_entries: Entradas del nivel en memoria
+            max_bytes: Tamaño máximo del nivel en disco
+        """
+        self.path = path
+        self.ttl = ttl
+        self.stale = stale
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()  # {clave: (resultado, creado)}
+        self._lock = threading.Lock()
+        self._disk_cache = None
+        self._disk_lock = threading.Lock()
+    
+    @property
+    def _disk(self):
+        if self._disk_cache is None:
+            with self._disk_lock:
+                if self._disk_cache is None:
+                    self._disk_cache = ResponseCache(self.path, ttl=self.ttl + self.stale,
+                                                     max_bytes=self.max_bytes)
+        return self._disk_cache
+    
+    @staticmethod
+    def normalize_query(query):
+        """Forma canónica de una búsqueda: sin mayúsculas, tildes ni palabras vacías
+        
+        El orden se conserva: "vuelos madrid a barcelona" y "vuelos
+        barcelona a madrid" son búsquedas distintas.
+        """
+        words = re.findall(r'\w+', strip_accents(query.casefold()))
+        return " ".join(word for word in words if word not in SEARCH_CACHE_STOP_WORDS) or " ".join(words)
+    
+    def make_key(self, query, *variant):
+        """Clave de una búsqueda; `variant` distingue región, filtro, nº de resultados..."""
+        return "|".join(map(str, (*variant, self.normalize_query(query))))
+    
+    def get(self, key):
+        """Devuelve (resultado, fresco) o None si no está o ya no se puede servir"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None:
+            entry = self._disk.get_entry(key)
+            if entry is None:
+                return None
+            self._remember(key, entry)
+        result, created = entry
+        age = time.time() - created
+        if age > self.ttl + self.stale:
+            return None
+        return result, age <= self.ttl
+    
+    def put(self, key, result):
+        entry = (result, time.time())
+        self._remember(key, entry)
+        self._disk.put(key, result)
+    
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+    
+    def close(self):
+        if self._disk_cache is not None:
+            self._disk_cache.close()
+
+def extract_main_text(html):
+    """Texto principal de una página HTML, un bloque (párrafo, título...) por línea
+    
+    Quita navegación, scripts y demás ruido y prefiere <article> o <main>
+    si la página los tiene.
+    """
+    import lxml.html
+    
+    try:
+        document = lxml.html.fromstring(html)
+    except (ValueError, lxml.etree.ParserError):
+        # Texto con declaración de codificación XML: lxml solo la acepta en bytes
+        try:
+            document = lxml.html.fromstring(html.encode("utf-8") if isinstance(html, str) else html)
+        except (ValueError, lxml.etree.ParserError):
+            return ""
+    for element in document.xpath("|".join(f"//{tag}" for tag in PAGE_NOISE_TAGS)):
+        element.drop_tree()
+    
+    root = next(iter(document.xpath("//article") or document.xpath("//main")), document)
+    blocks = []
+    for element in root.iter(*PAGE_BLOCK_TAGS):
+        # Los bloques anidados (p dentro de li o td) ya se cuentan en su padre
+        if any(ancestor.tag in PAGE_BLOCK_TAGS for ancestor in element.iterancestors()):
+            continue
+        text = " ".join(element.text_content().split())
+        if len(text) > 30 or element.tag.startswith("h"):
+            blocks.append(text)
+    if not blocks:
+        blocks = [" ".join(root.text_content().split())]
+    return "\n".join(blocks)
+
+def chunk_text(text, chunk_chars=DEEP_SEARCH_CHUNK_CHARS):
+    """Agrupa las líneas de `text` en fragmentos de unos `chunk_chars` caracteres"""
+    chunks, current = [], ""
+    for line in text.splitlines():
+        while len(line) > chunk_chars:
+            chunks.append(line[:chunk_chars])
+            line = line[chunk_chars:]
+        if current and len(current) + len(line) > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+def rank_chunks(query, chunks, k1=1.5, b=0.75):
+    """Índices de los `chunks` relevantes para `query`, del más al menos relevante (BM25)
+    
+    Los fragmentos sin ningún término de la consulta se descartan; si la
+    consulta no tiene términos útiles se devuelven todos en orden.
+    """
+    def terms(text):
+        return [word for word in re.findall(r'\w+', strip_accents(text.casefold()))
+                if word not in SEARCH_CACHE_STOP_WORDS]
+    
+    query_terms = set(terms(query))
+    documents = [terms(chunk) for chunk in chunks]
+    if not query_terms or not documents:
+        return list(range(len(chunks)))
+    
+    average = sum(map(len, documents)) / len(documents) or 1
+    frequency = {term: sum(term in document for document in documents) for term in query_terms}
+    scores = []
+    for document in documents:
+        score = 0.0
+        for term in query_terms:
+            count = document.count(term)
+            if count:
+                idf = math.log(1 + (len(documents) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+                score += idf * count * (k1 + 1) / (count + k1 * (1 - b + b * len(document) / average))
+        scores.append(score)
+    return sorted((i for i in range(len(chunks)) if scores[i] > 0), key=lambda i: -scores[i])
+
+class PageFetcher:
+    def __init__(self, host_limit=PAGE_HOST_LIMIT, max_bytes=PAGE_MAX_BYTES, timeout=PAGE_FETCH_TIMEOUT):
+        """
+        Descarga de páginas para la búsqueda profunda
+        
+        Una sesión HTTP compartida reutiliza las conexiones; cada servidor
+        admite como mucho `host_limit` descargas a la vez y ninguna respuesta
+        se lee más allá de `max_bytes`.
+        
+        Args:
+            host_limit: Descargas simultáneas por servidor
+            max_bytes: Bytes máximos que se leen de cada página
+            timeout: Segundos por página
+        """
+        self.host_limit = host_limit
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._session = None
+        self._hosts = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.headers["User-Agent"] = "Mozilla/5.0 (compatible; agente_ia)"
+                adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=self.host_limit)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+    
+    def _host_slot(self, url):
+        host = url.split("://", 1)[-1].split("/", 1)[0].lower()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.host_limit)
+            return self._hosts[host]
+    
+    def fetch(self, url):
+        """Devuelve el HTML de `url` (como mucho `max_bytes`) o None
+        
+        Se devuelve texto si se conoce la codificación (cabecera o UTF-8
+        válido) y bytes en otro caso, para que lxml la lea del <meta>.
+        """
+        with self._host_slot(url):
+            try:
+                with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                    content_type = response.headers.get("Content-Type", "")
+                    if response.status_code != 200 or "html" not in content_type:
+                        return None
+                    try:
+                        declared = int(response.headers.get("Content-Length") or 0)
+                    except ValueError:
+                        declared = 0  # Cabecera malformada: se trata como ausente
+                    if declared > self.max_bytes * 4:
+                        return None
+                    data = bytearray()
+                    for block in response.iter_content(64 * 1024):
+                        data.extend(block)
+                        if len(data) >= self.max_bytes:
+                            break
+                    data = bytes(data[:self.max_bytes])
+            except requests.RequestException:
+                return None
+        
+        charset = re.search(r'charset=["\']?([\w-]+)', content_type)
+        try:
+            return data.decode(charset.group(1) if charset else "utf-8", errors="replace" if charset else "strict")
+        except (UnicodeDecodeError, LookupError):
+            return data
+    
+    def fetch_all(self, urls):
+        """Descarga `urls` en paralelo y devuelve los resultados en el mismo orden"""
+        if not urls:
+            return []
+        with futures.ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="page-fetch") as pool:
+            return list(pool.map(self.fetch, urls))
+    
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+class SearchIndex:
+    def __init__(self, path, max_bytes=SEARCH_INDEX_MAX_BYTES):
+        """
+        Índice local de texto completo con páginas y fragmentos ya descargados
+        
+        Usa SQLite FTS5 (ranking BM25, sin tildes ni mayúsculas). Cada URL
+        se guarda una vez: si vuelve con otro contenido se actualiza y un
+        texto idéntico bajo otra URL no se duplica. Si el texto supera
+        `max_bytes` se eliminan los documentos menos consultados.
+        
+        Args:
+            path: Archivo SQLite del índice
+            max_bytes: Tamaño máximo del texto indexado
+        
+        Raises:
+            sqlite3.OperationalError: si el SQLite del sistema no incluye FTS5
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                url TEXT UNIQUE NOT NULL,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                added REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_hash ON documents(hash);
+            CREATE INDEX IF NOT EXISTS documents_accessed ON documents(accessed);
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts
+                USING fts5(title, body, tokenize='unicode61 remove_diacritics 2');
+        """)
+    
+    @staticmethod
+    def match_query(query):
+        """Consulta FTS5 con todos los términos útiles de `query` (None si no hay ninguno)"""
+        terms = [word for word in re.findall(r'\w+', strip_accents(query.casefold()))
+                 if word not in SEARCH_CACHE_STOP_WORDS]
+        return " ".join(f'"{term}"' for term in dict.fromkeys(terms)) or None
+    
+    def add(self, url, title, body):
+        """Indexa un documento (o lo actualiza si la URL ya existía con otro texto)"""
+        body = body.strip()
+        if not url or not body:
+            return
+        digest = hashlib.sha1(" ".join(body.split()).casefold().encode('utf-8')).hexdigest()
+        size = len(title.encode('utf-8')) + len(body.encode('utf-8'))
+        now = time.time()
+        
+        with self._lock, self._db:
+            row = self._db.execute("SELECT id, hash, size FROM documents WHERE url = ?", (url,)).fetchone()
+            if row and (row[1] == digest or row[2] > size):
+                # Mismo texto, o ya se tiene uno más completo (la página frente al fragmento)
+                self._db.execute("UPDATE documents SET accessed = ? WHERE id = ?", (now, row[0]))
+                return
+            if self._db.execute("SELECT 1 FROM documents WHERE hash = ? AND url != ?", (digest, url)).fetchone():
+                return
+            
+            if row:
+                self._db.execute("UPDATE documents SET hash = ?, size = ?, added = ?, accessed = ? WHERE id = ?",
+                                 (digest, size, now, now, row[0]))
+                self._db.execute("DELETE FROM documents_fts WHERE rowid = ?", (row[0],))
+                doc_id = row[0]
+            else:
+                doc_id = self._db.execute("INSERT INTO documents (url, hash, size, added, accessed) "
+                                          "VALUES (?, ?, ?, ?, ?)", (url, digest, size, now, now)).lastrowid
+            self._db.execute("INSERT INTO documents_fts (rowid, title, body) VALUES (?, ?, ?)",
+                             (doc_id, title, body))
+            self._evict()
+    
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess, evict = total - self.max_bytes, []
+        for doc_id, size in self._db.execute("SELECT id, size FROM documents ORDER BY accessed"):
+            if excess <= 0:
+                break
+            evict.append((doc_id,))
+            excess -= size
+        self._db.executemany("DELETE FROM documents WHERE id = ?", evict)
+        self._db.executemany("DELETE FROM documents_fts WHERE rowid = ?", evict)
+    
+    def search(self, query, limit=5):
+        """Documentos que contienen todos los términos de `query`, ordenados por BM25
+        
+        Returns:
+            [{'title', 'body' (fragmento alrededor de los términos), 'url'}, ...]
+        """
+        match = self.match_query(query)
+        if match is None:
+            return []
+        with self._lock, self._db:
+            rows = self._db.execute("""
+                SELECT d.id, d.url, f.title, snippet(documents_fts, 1, '', '', '…', 48)
+                FROM documents_fts f JOIN documents d ON d.id = f.rowid
+                WHERE documents_fts MATCH ? ORDER BY bm25(documents_fts) LIMIT ?
+            """, (match, limit)).fetchall()
+            self._db.executemany("UPDATE documents SET accessed = ? WHERE id = ?",
+                                 [(time.time(), row[0]) for row in rows])
+        return [{'title': title, 'body': body, 'url': url} for _, url, title, body in rows]
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class SearchClientPool:
+    def __init__(self, size=SEARCH_POOL_SIZE, region=SEARCH_REGION, safesearch=SEARCH_SAFESEARCH,
+                 retries=SEARCH_RETRIES, backoff=SEARCH_BACKOFF):
+        """
+        Pool de clientes DDGS de larga duración
+        
+        Cada DDGS mantiene su propio cliente HTTP (primp) con la sesión TLS
+        y las cookies; crearlo en cada búsqueda repetía el handshake. Los
+        clientes se crean al necesitarlos, cada uno lo usa un solo hilo a
+        la vez y vuelven al pool tras la búsqueda. Ante un límite de
+        peticiones se reintenta con espera exponencial.
+        
+        Args:
+            size: Clientes como máximo (búsquedas simultáneas)
+            region: Región de DuckDuckGo
+            safesearch: Filtro de contenido (on, moderate, off); duckduckgo_search 8.x
+                lo acepta pero no lo aplica en las búsquedas de texto
+            retries: Intentos ante un límite de peticiones
+            backoff: Segundos de la primera espera entre intentos
+        """
+        self.region = region
+        self.safesearch = safesearch
+        self.retries = max(1, retries)
+        self.backoff = backoff
+        self._idle = queue.LifoQueue()  # El último devuelto es el de conexión más reciente
+        self._slots = threading.BoundedSemaphore(size)
+    
+    @contextmanager
+    def client(self):
+        """Presta un cliente DDGS en exclusiva; se descarta si la búsqueda falla"""
+        from duckduckgo_search import DDGS
+        
+        with self._slots:
+            try:
+                ddgs = self._idle.get_nowait()
+            except queue.Empty:
+                ddgs = DDGS()
+            # DDGS espera 0,75 s si su petición anterior fue hace menos de 20 s; esa pausa
+            # separa las peticiones de una misma búsqueda, no búsquedas distintas (de eso se encarga
+            # el reintento con espera de `text`), así que el cliente se presta sin ella
+            ddgs.sleep_timestamp = 0.0
+            yield ddgs
+            # Solo vuelve al pool si la búsqueda terminó bien: tras un error
+            # (red, límite de peticiones) la próxima búsqueda usa un cliente nuevo
+            self._idle.put(ddgs)
+    
+    def text(self, query, max_results=5):
+        """Resultados de texto de DuckDuckGo para `query`"""
+        from duckduckgo_search.exceptions import DuckDuckGoSearchException
+        
+        for attempt in range(self.retries):
+            try:
+                with self.client() as ddgs:
+                    return ddgs.text(query, region=self.region, safesearch=self.safesearch,
+                                     max_results=max_results) or []
+            except DuckDuckGoSearchException as e:
+                if not self.is_ratelimit(e) or attempt == self.retries - 1:
+                    raise
+                # Espera exponencial con algo de azar para no sincronizar los reintentos
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.8, 1.2))
+    
+    @staticmethod
+    def is_ratelimit(error):
+        """Si el error es un límite de peticiones
+        
+        DDGS.text captura el error de cada backend y lo relanza envuelto
+        en un DuckDuckGoSearchException genérico, así que el
+        RatelimitException original solo queda en sus argumentos y en el
+        texto del mensaje.
+        """
+        from duckduckgo_search.exceptions import RatelimitException
+        
+        wrapped = [error, error.__cause__, *error.args]
+        return (any(isinstance(item, RatelimitException) for item in wrapped)
+                or "ratelimit" in str(error).lower())
+    
+    def close(self):
+        """Olvida los clientes inactivos (primp cierra sus conexiones al liberarlos)"""
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                return
+
+class ToolsNotSupportedError(RuntimeError):
+    """El modelo no admite tool calling nativo (`tools` en /api/chat)"""
+
+class OllamaClient:
+    def __init__(self, base_url=None, timeout=120):
+        """
+        Cliente HTTP para la API REST de Ollama con una sesión keep-alive
+        
+        Args:
+            base_url: URL del servidor de Ollama (por defecto $OLLAMA_HOST)
+            timeout: Tiempo máximo de espera por petición en segundos
+        """
+        base_url = base_url or os.environ.get("OLLAMA_HOST") or DEFAULT_OLLAMA_HOST
+        if not base_url.startswith(("http://", "https://")):
+            base_url = f"http://{base_url}"
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        
+        self._session = None
+    
+    @property
+    def session(self):
+        """Sesión HTTP compartida, creada en la primera petición"""
+        if self._session is None:
+            # Una sola sesión reutiliza la conexión TCP entre turnos y reintentos
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+    
+    def _post(self, endpoint, payload, stream=False):
+        """Envía una petición POST a la API y valida el código de estado"""
+        response = self.session.post(f"{self.base_url}{endpoint}", json=payload,
+                                     timeout=self.timeout, stream=stream)
+        if response.status_code != 200:
+            try:
+                detail = response.json().get('error', response.text)
+            except ValueError:
+                detail = response.text
+            raise requests.HTTPError(f"HTTP {response.status_code}: {detail}", response=response)
+        return response
+    
+    def _stream(self, endpoint, payload):
+        """Produce cada fragmento JSON (NDJSON) de una respuesta en streaming"""
+        with self._post(endpoint, payload, stream=True) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    raise RuntimeError(chunk['error'])
+                yield chunk
+                if chunk.get('done'):
+                    break
+    
+    @staticmethod
+    def _generate_payload(model, prompt, system, options, stream, extra):
+        payload = {"model": model, "prompt": prompt, "stream": stream}
+        if system:
+            payload["system"] = system
+        if options:
+            payload["options"] = options
+        payload.update(extra)
+        return payload
+    
+    @staticmethod
+    def _chat_payload(model, messages, options, stream, extra):
+        payload = {"model": model, "messages": messages, "stream": stream}
+        if options:
+            payload["options"] = options
+        payload.update(extra)
+        return payload
+    
+    def generate(self, model, prompt, system=None, options=None, **extra):
+        """Llama a /api/generate y devuelve el JSON de la respuesta"""
+        payload = self._generate_payload(model, prompt, system, options, False, extra)
+        return self._post("/api/generate", payload).json()
+    
+    def generate_stream(self, model, prompt, system=None, options=None, **extra):
+        """Llama a /api/generate en streaming y produce los fragmentos a medida que llegan"""
+        payload = self._generate_payload(model, prompt, system, options, True, extra)
+        yield from self._stream("/api/generate", payload)
+    
+    def chat(self, model, messages, options=None, **extra):
+        """Llama a /api/chat y devuelve el JSON de la respuesta"""
+        payload = self._chat_payload(model, messages, options, False, extra)
+        return self._post("/api/chat", payload).json()
+    
+    def chat_stream(self, model, messages, options=None, **extra):
+        """Llama a /api/chat en streaming y produce los fragmentos a medida que llegan"""
+        payload = self._chat_payload(model, messages, options, True, extra)
+        yield from self._stream("/api/chat", payload)
+    
+    def embed(self, model, inputs):
+        """Llama a /api/embed y devuelve un vector por cada texto de `inputs`"""
+        return self._post("/api/embed", {"model": model, "input": inputs}).json()["embeddings"]
+    
+    def list_models(self):
+        """Consulta /api/tags y devuelve los modelos instalados"""
+        response = self.session.get(f"{self.base_url}/api/tags", timeout=10)
+        response.raise_for_status()
+        return [{
+            'name': m['name'],
+            'size': format_size(m.get('size', 0)),
+            'modified': m.get('modified_at', '')
+        } for m in response.json().get('models', [])]
+    
+    def close(self):
+        """Cierra las conexiones abiertas del pool"""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
 class OpenSourceAgent:
-    def __init__(self, model_name="llama3.2", verbose=True):
+    def __init__(self, model_name="llama3.2", verbose=True, ollama_host=None, stream=True,
+                 model_cache_ttl=MODEL_CACHE_TTL, skip_checks=False, background_checks=False,
+                 context_length=DEFAULT_CONTEXT_LENGTH, kv_context=True, temperature=None, seed=None,
+                 response_cache=False, max_steps=MAX_AGENT_STEPS, tool_mode="text", semantic_router=None,
+                 speculative=True, search_region=SEARCH_REGION, safesearch=SEARCH_SAFESEARCH,
+                 search_cache=True, deep_search=0, search_index=False, weather_url=WEATHER_URL,
+                 weather_cache_ttl=WEATHER_CACHE_TTL):
         """
         Agente de IA completamente open source - Versión Optimizada
         
         Args:
             model_name: Modelo de Ollama a usar
             verbose: Mostrar información detallada
+            ollama_host: URL de la API de Ollama (por defecto $OLLAMA_HOST)
+            stream: Mostrar la respuesta token a token en el modo interactivo
+            model_cache_ttl: Segundos de validez del inventario de modelos en disco (0 = sin caché)
+            skip_checks: No verificar Ollama ni el modelo al arrancar (--fast-start)
+            background_checks: Verificar Ollama en un hilo sin bloquear el arranque
+            context_length: Tamaño de contexto (num_ctx) para el modelo y la ventana de conversación
+            kv_context: Reutilizar entre turnos el vector `context` de Ollama (caché KV)
+            temperature: Temperatura de muestreo (None = la del modelo)
+            seed: Semilla fija de muestreo
+            response_cache: Cachear en disco las respuestas del modelo (solo con
+                muestreo determinista: temperature=0 o seed fija)
+            max_steps: Máximo de llamadas al modelo por consulta en el bucle
+                modelo → herramientas → observación (1 = sin bucle)
+            tool_mode: "text" (protocolo USE_TOOL), "native" (tool calling JSON
+                de Ollama) o "auto" (nativo si el modelo lo soporta, si no texto)
+            semantic_router: Modelo de embeddings para enrutar por similitud las
+                consultas que no reconocen las palabras clave ("hash" = embedding
+                local sin modelo; None = desactivado). Requiere numpy
+            speculative: Lanzar web_search/weather mientras el modelo genera
+                cuando la consulta probablemente los necesita
+            search_region: Región de DuckDuckGo para web_search (wt-wt, es-es, mx-es...)
+            safesearch: Filtro de contenido de DuckDuckGo (on, moderate, off; ignorado
+                por las búsquedas de texto de duckduckgo_search 8.x)
+            search_cache: Cachear los resultados de web_search (memoria + disco,
+                con refresco en segundo plano de los caducados)
+            deep_search: Páginas de resultados que web_search descarga para
+                entregar al modelo los extractos más relevantes (0 = solo
+                los fragmentos de DuckDuckGo). Requiere lxml
+            search_index: Guardar en un índice local de texto completo lo que
+                devuelven las búsquedas y responder desde él antes de ir a la red
+            weather_url: URL base del servicio de clima con el formato de wttr.in
+                (por defecto $AGENTE_WEATHER_URL o https://wttr.in)
+            weather_cache_ttl: Segundos que se reutiliza el clima de una ciudad (0 = sin caché)
         """
         self.model_name = model_name
         self.verbose = verbose
+        self.stream = stream
+        self.model_cache_ttl = model_cache_ttl
+        self._checks_thread = None
+        self._internet_ok = None  # Se comprueba al usar la primera herramienta de red
+        self._internet_checked_at = 0.0
+        self._internet_lock = threading.Lock()
+        self.ollama = OllamaClient(ollama_host)
+        self.use_http = True  # Se desactiva si la API no responde y se usa la CLI
         self.conversation_history = []
+        self.window = ConversationWindow(context_length)
+        self.llm_options = {"num_ctx": context_length}
+        if temperature is not None:
+            self.llm_options["temperature"] = temperature
+        if seed is not None:
+            self.llm_options["seed"] = seed
+        self.kv_context = kv_context
+        self.scheduler = ToolScheduler()
+        self.search_pool = SearchClientPool(region=search_region, safesearch=safesearch)
+        self.router = IntentRouter()
+        self.speculative = speculative
+        self.speculation_outcomes = deque(maxlen=SPECULATION_WINDOW)  # True/False = aprovechado/descartado
+        self.max_steps = max(1, max_steps)
+        if tool_mode not in TOOL_MODES:
+            raise ValueError(f"tool_mode debe ser uno de {TOOL_MODES}")
+        self.tool_mode = tool_mode
+        self.native_tools_supported = None  # Se descubre en la primera llamada nativa
+        self._tool_schema_cache = None
+        self._system_prompt_cache = None  # (herramientas, parte fija del system prompt)
         self.tools = {
             "web_search": self.web_search,
             "calculator": self.calculator,
@@ -52,12 +1729,71 @@ class OpenSourceAgent:
         self.work_dir = Path("agente_workspace")
         self.work_dir.mkdir(exist_ok=True)
         
+        self.semantic_router = None
+        if semantic_router:
+            if NUMPY_AVAILABLE:
+                embed = hash_embeddings if semantic_router == "hash" else \
+                    (lambda texts: self.ollama.embed(semantic_router, texts))
+                safe_name = re.sub(r'[^\w.-]', '_', semantic_router)
+                self.semantic_router = SemanticRouter(embed, self.work_dir / ".cache" / f"intents_{safe_name}.npz",
+                                                      model=semantic_router)
+            else:
+                self.print_message("numpy no está instalado: enrutador semántico desactivado", "warning")
+        
+        self.deep_search = 0
+        self.page_fetcher = None
+        if deep_search:
+            if lxml_available():
+                self.deep_search = deep_search
+                self.page_fetcher = PageFetcher()
+            else:
+                self.print_message("lxml no está instalado o no se puede importar: búsqueda profunda desactivada", "warning")
+        
+        self.weather_base = weather_url.rstrip("/")
+        # Un servidor local (p. ej. con respuestas grabadas) no necesita comprobar internet
+        self.weather_local = is_loopback_url(self.weather_base)
+        self.weather_cache_ttl = weather_cache_ttl
+        self._weather_cache = {}  # {ciudad normalizada: (datos, instante)}
+        self._weather_lock = threading.Lock()
+        self._weather_session = None
+        
+        self.search_index = None
+        if search_index:
+            try:
+                self.search_index = SearchIndex(self.work_dir / "search_index.sqlite")
+            except sqlite3.OperationalError as e:
+                self.print_message(f"Índice local de búsquedas desactivado: {str(e)}", "warning")
+        
+        self.search_cache = None
+        self._search_lock = threading.Lock()
+        self._revalidating = set()
+        if search_cache:
+            self.search_cache = SearchCache(self.work_dir / ".cache" / "search.sqlite")
+        
+        self.response_cache = None
+        if response_cache:
+            self.response_cache = ResponseCache(self.work_dir / ".cache" / "llm_responses.sqlite")
+        
         # Verificar instalación
-        self.setup_check()
+        if skip_checks:
+            pass
+        elif background_checks:
+            self._checks_thread = threading.Thread(target=self.setup_check, kwargs={'exit_on_error': False},
+                                                   name="setup-check", daemon=True)
+            self._checks_thread.start()
+        else:
+            self.setup_check()
     
     def print_message(self, message, style="info"):
         """Imprime mensajes con estilo si Rich está disponible"""
-        if RICH_AVAILABLE and console:
+        if threading.current_thread() is self._checks_thread:
+            # Verificación en segundo plano: stdout es de la respuesta (--query, --json),
+            # así que solo los avisos (o todo en modo verbose) van a stderr
+            if self.verbose or style in ("warning", "error"):
+                icon = {"success": "✅ ", "error": "❌ ", "warning": "⚠️  ", "info": "ℹ️  "}.get(style, "")
+                print(f"{icon}{message}", file=sys.stderr)
+            return
+        if get_console():
             if style == "success":
                 console.print(f"✅ {message}", style="green")
             elif style == "error":
@@ -71,62 +1807,138 @@ class OpenSourceAgent:
         else:
             print(f"{message}")
     
-    def setup_check(self):
-        """Verificación completa del sistema"""
+    def setup_check(self, exit_on_error=True):
+        """Verificación completa del sistema
+        
+        La conexión a internet no se comprueba aquí: se verifica la primera
+        vez que se usa una herramienta de red (ver `ensure_internet`).
+        """
         self.print_message("Iniciando verificación del sistema...", "info")
         
         # Verificar Ollama
         if not self.check_ollama():
             self.print_message("Ollama no está configurado correctamente", "error")
-            sys.exit(1)
+            if exit_on_error:
+                sys.exit(1)
+            return
         
         # Verificar modelo
         if not self.check_model():
             self.print_message(f"El modelo {self.model_name} no está disponible", "warning")
             self.suggest_models()
         
-        # Verificar conexión a internet
-        if self.check_internet():
-            self.print_message("Conexión a internet: OK", "success")
-        else:
-            self.print_message("Sin conexión a internet - funciones web limitadas", "warning")
-        
         self.print_message("Sistema listo para usar", "success")
     
-    def check_ollama(self):
-        """Verifica si Ollama está instalado y funcionando"""
+    def wait_for_checks(self):
+        """Espera a que terminen las verificaciones en segundo plano (si las hay)"""
+        if self._checks_thread is not None:
+            self._checks_thread.join()
+            self._checks_thread = None
+    
+    @staticmethod
+    def parse_ollama_list(output):
+        """Convierte la tabla de `ollama list` en una lista de modelos"""
+        models = []
+        for line in output.splitlines()[1:]:
+            columns = re.split(r'\s{2,}', line.strip())
+            if not columns or not columns[0]:
+                continue
+            models.append({
+                'name': columns[0],
+                'size': columns[2] if len(columns) > 2 else '',
+                'modified': columns[3] if len(columns) > 3 else ''
+            })
+        return models
+    
+    def _model_cache_file(self):
+        return self.work_dir / ".cache" / "ollama_models.json"
+    
+    def _read_model_cache(self):
+        """Lee el inventario de modelos en disco si no ha caducado"""
+        if self.model_cache_ttl <= 0:
+            return None
         try:
-            result = subprocess.run(['ollama', 'list'], 
+            data = json.loads(self._model_cache_file().read_text(encoding='utf-8'))
+            if data.get('host') == self.ollama.base_url and time.time() - data['timestamp'] < self.model_cache_ttl:
+                return data['models']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+    
+    def _write_model_cache(self, models):
+        if self.model_cache_ttl <= 0:
+            return
+        try:
+            cache_file = self._model_cache_file()
+            cache_file.parent.mkdir(exist_ok=True)
+            cache_file.write_text(json.dumps({
+                'host': self.ollama.base_url,
+                'timestamp': time.time(),
+                'models': models
+            }), encoding='utf-8')
+        except OSError:
+            pass
+    
+    def _probe_models(self):
+        """Consulta los modelos instalados (API HTTP o `ollama list`); None si Ollama no responde"""
+        if self.use_http:
+            try:
+                return self.ollama.list_models()
+            except requests.RequestException:
+                pass
+        
+        try:
+            result = subprocess.run(['ollama', 'list'],
                                  capture_output=True, text=True, timeout=10)
-            return result.returncode == 0
         except (FileNotFoundError, subprocess.TimeoutExpired):
-            return False
+            return None
+        if result.returncode != 0:
+            return None
+        return self.parse_ollama_list(result.stdout)
+    
+    def list_models(self, refresh=False):
+        """Inventario de modelos instalados, consultado una sola vez por proceso
+        
+        Returns:
+            Lista de dicts con 'name', 'size' y 'modified', o None si Ollama no responde
+        """
+        host = self.ollama.base_url
+        if not refresh:
+            if host in _model_inventory:
+                return _model_inventory[host]
+            cached = self._read_model_cache()
+            if cached is not None:
+                _model_inventory[host] = cached
+                return cached
+        
+        models = self._probe_models()
+        if models is not None:
+            # Solo se memoizan los sondeos correctos para poder reintentar si Ollama arranca después
+            _model_inventory[host] = models
+            self._write_model_cache(models)
+        return models
+    
+    def check_ollama(self):
+        """Verifica si Ollama está instalado y funcionando"""
+        return self.list_models() is not None
     
     def check_model(self):
         """Verifica si el modelo especificado está disponible"""
-        try:
-            result = subprocess.run(['ollama', 'list'], 
-                                 capture_output=True, text=True, timeout=10)
-            return self.model_name in result.stdout
-        except:
-            return False
+        for model in self.list_models() or []:
+            if model['name'] == self.model_name or model['name'].split(':')[0] == self.model_name:
+                return True
+        return False
     
     def suggest_models(self):
         """Sugiere modelos disponibles o cómo instalarlos"""
-        try:
-            result = subprocess.run(['ollama', 'list'], 
-                                 capture_output=True, text=True, timeout=10)
-            available_models = [line.split()[0] for line in result.stdout.split('\n')[1:] if line.strip()]
-            
-            if available_models:
-                self.print_message(f"Modelos disponibles: {', '.join(available_models)}", "info")
-                if available_models:
-                    self.model_name = available_models[0]
-                    self.print_message(f"Usando modelo: {self.model_name}", "info")
-            else:
-                self.print_message("No hay modelos instalados. Ejecuta: ollama pull llama3.2", "warning")
-        except:
-            pass
+        available_models = [model['name'] for model in self.list_models() or []]
+        
+        if available_models:
+            self.print_message(f"Modelos disponibles: {', '.join(available_models)}", "info")
+            self.model_name = available_models[0]
+            self.print_message(f"Usando modelo: {self.model_name}", "info")
+        else:
+            self.print_message("No hay modelos instalados. Ejecuta: ollama pull llama3.2", "warning")
     
     def check_internet(self):
         """Verifica conexión a internet"""
@@ -136,42 +1948,316 @@ class OpenSourceAgent:
         except:
             return False
     
-    def call_ollama(self, prompt, system_prompt=None, max_retries=3):
-        """Llama al modelo local usando Ollama con reintentos"""
+    def ensure_internet(self):
+        """Comprueba la conexión una sola vez, al usar la primera herramienta de red
+        
+        Un resultado positivo se conserva toda la sesión; uno negativo se
+        vuelve a comprobar tras INTERNET_RECHECK_INTERVAL segundos.
+        """
+        with self._internet_lock:
+            if self._internet_ok or (self._internet_ok is False and
+                                     time.monotonic() - self._internet_checked_at < INTERNET_RECHECK_INTERVAL):
+                return self._internet_ok
+            
+            self._internet_ok = self.check_internet()
+            self._internet_checked_at = time.monotonic()
+            if not self._internet_ok:
+                self.print_message("Sin conexión a internet - funciones web limitadas", "warning")
+            return self._internet_ok
+    
+    @contextmanager
+    def thinking_indicator(self, description="Pensando..."):
+        """Muestra un indicador de progreso mientras el modelo responde"""
+        if get_console():
+            from rich.progress import Progress, SpinnerColumn, TextColumn
+            
+            with Progress(
+                SpinnerColumn(),
+                TextColumn("[progress.description]{task.description}"),
+                console=console,
+                transient=True,
+            ) as progress:
+                progress.add_task(description=description, total=None)
+                yield
+        else:
+            print(f"🤖 {description}", end='', flush=True)
+            try:
+                yield
+            finally:
+                print("\r", end='')
+    
+    def _kv_request(self, prompt, system_prompt, kv_session, messages=None):
+        """Argumentos de /api/generate que reutilizan el contexto KV de la sesión
+        
+        En los turnos de seguimiento solo se envía el mensaje nuevo: el
+        historial y el system prompt ya están evaluados dentro de `context`.
+        Si hay que sembrar un contexto nuevo se usa la conversación completa
+        (`messages`, que incluye los pasos previos del turno actual).
+        """
+        key = kv_session.context_key(self.model_name, system_prompt)
+        context = kv_session.reusable_context(key, prompt)
+        if context:
+            return key, {"prompt": prompt, "context": context}
+        if messages:
+            seed = kv_session.render_transcript(messages, system_prompt)
+        else:
+            seed = kv_session.transcript_prompt(prompt)
+        return key, {"prompt": seed, "system": system_prompt}
+    
+    def _call_ollama_http(self, prompt, system_prompt=None, messages=None, kv_session=None):
+        """Genera una respuesta con la API REST de Ollama (/api/chat si hay mensajes)"""
+        if kv_session is not None:
+            key, request = self._kv_request(prompt, system_prompt, kv_session, messages)
+            data = self.ollama.generate(self.model_name, options=self.llm_options, **request)
+            kv_session.store_context(key, data.get('context'))
+            return data.get('response', '').strip()
+        
+        if messages:
+            data = self.ollama.chat(self.model_name, messages, options=self.llm_options)
+            return data.get('message', {}).get('content', '').strip()
+        
+        data = self.ollama.generate(self.model_name, prompt, system=system_prompt, options=self.llm_options)
+        return data.get('response', '').strip()
+    
+    def _stream_ollama_http(self, prompt, system_prompt=None, messages=None, kv_session=None):
+        """Produce los tokens de la API REST de Ollama en streaming"""
+        if kv_session is not None:
+            key, request = self._kv_request(prompt, system_prompt, kv_session, messages)
+            for chunk in self.ollama.generate_stream(self.model_name, options=self.llm_options, **request):
+                if chunk.get('done'):
+                    kv_session.store_context(key, chunk.get('context'))
+                yield chunk.get('response', '')
+        elif messages:
+            for chunk in self.ollama.chat_stream(self.model_name, messages, options=self.llm_options):
+                yield chunk.get('message', {}).get('content', '')
+        else:
+            for chunk in self.ollama.generate_stream(self.model_name, prompt, system=system_prompt,
+                                                     options=self.llm_options):
+                yield chunk.get('response', '')
+    
+    def _cli_command(self, prompt, system_prompt=None, messages=None):
+        """Construye el comando `ollama run` con el system prompt (o la conversación) incrustado"""
+        if messages:
+            roles = {"system": "System", "user": "User", "assistant": "Assistant"}
+            full_prompt = "\n\n".join(f"{roles.get(m['role'], m['role'])}: {m['content']}" for m in messages)
+        elif system_prompt:
+            full_prompt = f"System: {system_prompt}\n\nUser: {prompt}"
+        else:
+            full_prompt = prompt
+        return ['ollama', 'run', self.model_name, full_prompt]
+    
+    def _call_ollama_cli(self, prompt, system_prompt=None, messages=None):
+        """Genera una respuesta con `ollama run` (respaldo si la API no está disponible)"""
+        cmd = self._cli_command(prompt, system_prompt, messages)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip())
+        return result.stdout.strip()
+    
+    def _stream_ollama_cli(self, prompt, system_prompt=None, messages=None, timeout=120):
+        """Lee la salida de `ollama run` a medida que el proceso la escribe"""
+        cmd = self._cli_command(prompt, system_prompt, messages)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # os.read bloquea: si el proceso no escribe nada, el vigilante lo termina
+        # al vencer el plazo y la lectura recibe el fin de la salida
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            proc.kill()
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            while True:
+                data = os.read(proc.stdout.fileno(), 4096)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            
+            returncode = proc.wait()
+            if expired.is_set():
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            if returncode != 0:
+                raise RuntimeError(proc.stderr.read().decode('utf-8', errors='replace').strip())
+        finally:
+            watchdog.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+    
+    def http_or_cli(self, request, fallback):
+        """Hace una petición por la API HTTP y, si el servidor no responde, usa `fallback`
+        
+        Es el único sitio que decide entre la API y la CLI: tras el primer
+        fallo de conexión se usa la CLI durante el resto de la sesión.
+        
+        Args:
+            request: Callable sin argumentos que hace la petición HTTP. Si
+                devuelve un generador (streaming) se adelanta su primer
+                elemento, que es cuando se abre la conexión; si devuelve una
+                corrutina, el resultado es otra corrutina que hace lo mismo
+                al esperarla.
+            fallback: Callable sin argumentos con la alternativa (la CLI)
+        """
+        unreachable = (requests.ConnectionError, ConnectionError)
+        if not self.use_http:
+            return fallback()
+        try:
+            response = request()
+            if inspect.isgenerator(response):
+                response = self._prefetched(next(response, None), response)
+        except unreachable:
+            self._switch_to_cli()
+            return fallback()
+        
+        if inspect.iscoroutine(response):
+            async def awaited():
+                try:
+                    return await response
+                except unreachable:
+                    self._switch_to_cli()
+                    return await fallback()
+            return awaited()
+        return response
+    
+    @staticmethod
+    def _prefetched(first, rest):
+        if first is not None:
+            yield first
+        yield from rest
+    
+    def _switch_to_cli(self):
+        self.use_http = False
+        self.print_message("API de Ollama no disponible, usando la CLI", "warning")
+    
+    def call_ollama_stream(self, prompt, system_prompt=None, max_retries=3, messages=None, kv_session=None):
+        """Genera la respuesta del modelo token a token a medida que llega"""
+        self.wait_for_checks()
         for attempt in range(max_retries):
+            started = False
             try:
-                # Construir el prompt completo
-                if system_prompt:
-                    full_prompt = f"System: {system_prompt}\n\nUser: {prompt}"
-                else:
-                    full_prompt = prompt
+                tokens = self.http_or_cli(
+                    lambda: self._stream_ollama_http(prompt, system_prompt, messages, kv_session),
+                    lambda: self._stream_ollama_cli(prompt, system_prompt, messages))
+                for token in tokens:
+                    if token:
+                        started = True
+                        yield token
+                return
                 
-                # Mostrar progreso si Rich está disponible
-                if RICH_AVAILABLE and console:
-                    with Progress(
-                        SpinnerColumn(),
-                        TextColumn("[progress.description]{task.description}"),
-                        console=console,
-                        transient=True,
-                    ) as progress:
-                        task = progress.add_task(description="Pensando...", total=None)
-                        
-                        # Llamar a Ollama
-                        cmd = ['ollama', 'run', self.model_name, full_prompt]
-                        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-                
-                else:
-                    print("🤖 Pensando...", end='', flush=True)
-                    cmd = ['ollama', 'run', self.model_name, full_prompt]
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-                    print("\r", end='')
-                
-                if result.returncode == 0:
-                    return result.stdout.strip()
-                else:
-                    self.print_message(f"Error en intento {attempt + 1}: {result.stderr}", "warning")
+            except (subprocess.TimeoutExpired, requests.Timeout):
+                self.print_message(f"Timeout en intento {attempt + 1}", "warning")
+            except Exception as e:
+                self.print_message(f"Error en intento {attempt + 1}: {str(e)}", "warning")
+            
+            # Reintentar tras haber emitido tokens duplicaría la salida
+            if started:
+                return
+        
+        yield "Error: No se pudo obtener respuesta después de varios intentos"
+    
+    def call_ollama_native(self, messages, on_token=None, max_retries=3):
+        """Llama a /api/chat anunciando las herramientas como definiciones JSON
+        
+        Returns:
+            (texto de la respuesta, lista de `tool_calls` estructuradas), o
+            None si la API HTTP no está disponible (se pasa a la CLI)
+        
+        Raises:
+            ToolsNotSupportedError: si el modelo no soporta herramientas nativas
+        """
+        self.wait_for_checks()
+        tools = self.tool_schemas()
+        
+        def request():
+            if on_token:
+                content, tool_calls = [], []
+                for chunk in self.ollama.chat_stream(self.model_name, messages, options=self.llm_options,
+                                                     tools=tools):
+                    message = chunk.get('message', {})
+                    if message.get('content'):
+                        content.append(message['content'])
+                        on_token(message['content'])
+                    tool_calls.extend(message.get('tool_calls') or [])
+                return "".join(content).strip(), tool_calls
+            
+            with self.thinking_indicator():
+                data = self.ollama.chat(self.model_name, messages, options=self.llm_options, tools=tools)
+            message = data.get('message', {})
+            return message.get('content', '').strip(), message.get('tool_calls') or []
+        
+        for attempt in range(max_retries):
+            try:
+                # Sin servidor HTTP no hay tool calling nativo: el modo texto usará la CLI
+                return self.http_or_cli(request, lambda: None)
+            except requests.HTTPError as e:
+                if "does not support tools" in str(e):
+                    raise ToolsNotSupportedError(str(e)) from e
+                self.print_message(f"Error en intento {attempt + 1}: {str(e)}", "warning")
+            except requests.Timeout:
+                self.print_message(f"Timeout en intento {attempt + 1}", "warning")
+        
+        return "Error: No se pudo obtener respuesta después de varios intentos", []
+    
+    def _response_cache_key(self, prompt, system_prompt, messages):
+        """Clave de caché de la petición, o None si la caché no aplica
+        
+        Solo se cachea con muestreo determinista: con temperatura > 0 y sin
+        semilla, dos llamadas iguales pueden (y deben) dar respuestas distintas.
+        """
+        if self.response_cache is None:
+            return None
+        if self.llm_options.get("temperature") != 0 and "seed" not in self.llm_options:
+            return None
+        return ResponseCache.make_key(self.model_name, system_prompt, messages or prompt, self.llm_options)
+    
+    def call_ollama(self, prompt, system_prompt=None, max_retries=3, on_token=None, messages=None,
+                    kv_session=None):
+        """Llama al modelo local usando la API HTTP de Ollama con reintentos
+        
+        Si se pasa `on_token`, la respuesta se genera en streaming y cada
+        token se entrega al callback a medida que llega. Si se pasan
+        `messages` (modo chat), se usan en lugar de `prompt` y `system_prompt`.
+        Con `kv_session` (una ConversationWindow) se reutiliza el vector
+        `context` de Ollama entre turnos; `messages` queda como respaldo para la CLI.
+        """
+        cache_key = self._response_cache_key(prompt, system_prompt, messages)
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                if kv_session is not None:
+                    # El contexto KV no incluye este turno: se volverá a sembrar
+                    kv_session.store_context(None, None)
+                if on_token:
+                    on_token(cached)
+                return cached
+        
+        response = self._call_ollama_uncached(prompt, system_prompt, max_retries, on_token, messages, kv_session)
+        if cache_key and "Error:" not in response:
+            self.response_cache.put(cache_key, response)
+        return response
+    
+    def _call_ollama_uncached(self, prompt, system_prompt, max_retries, on_token, messages, kv_session):
+        """Genera la respuesta con el modelo (streaming si hay `on_token`)"""
+        if on_token:
+            tokens = []
+            for token in self.call_ollama_stream(prompt, system_prompt, max_retries, messages, kv_session):
+                tokens.append(token)
+                on_token(token)
+            return "".join(tokens).strip()
+        
+        self.wait_for_checks()
+        for attempt in range(max_retries):
+            try:
+                with self.thinking_indicator():
+                    return self.http_or_cli(
+                        lambda: self._call_ollama_http(prompt, system_prompt, messages, kv_session),
+                        lambda: self._call_ollama_cli(prompt, system_prompt, messages))
                     
-            except subprocess.TimeoutExpired:
+            except (subprocess.TimeoutExpired, requests.Timeout):
                 self.print_message(f"Timeout en intento {attempt + 1}", "warning")
             except Exception as e:
                 self.print_message(f"Error en intento {attempt + 1}: {str(e)}", "warning")
@@ -180,33 +2266,141 @@ class OpenSourceAgent:
     
     def web_search(self, query, max_results=5):
         """Búsqueda web optimizada usando DuckDuckGo - Devuelve información directa"""
+        cache_key = None
+        if self.search_cache:
+            cache_key = self.search_cache.make_key(query, self.search_pool.region,
+                                                   self.search_pool.safesearch, max_results, self.deep_search)
+            cached = self.search_cache.get(cache_key)
+            if cached:
+                payload, fresh = cached
+                try:
+                    found = json.loads(payload)
+                except ValueError:
+                    found = None  # Entrada de una versión anterior: se trata como fallo de caché
+                if found:
+                    if not fresh:
+                        self._revalidate_search(query, max_results, cache_key)
+                    return self.search_result(query, "cache", found['results'], found['extracts'])
+        
+        # Índice local: si ya hay suficientes documentos no hace falta la red
+        if self.search_index:
+            local = self.search_index.search(query, max_results)
+            if local and len(local) >= min(max_results, SEARCH_INDEX_MIN_HITS):
+                return self.search_result(query, "index", local)
+        
+        return self._search_uncached(query, max_results, cache_key)
+    
+    def _offline_search(self, query, max_results, message):
+        """Resultados del índice local cuando la red falla, o `message` si no hay ninguno"""
+        local = self.search_index.search(query, max_results) if self.search_index else []
+        return self.search_result(query, "index", local) if local else message
+    
+    def search_result(self, query, source, results, extracts=()):
+        """ToolResult de web_search; `source` es "web", "cache" o "index" """
+        data = {'query': query, 'source': source, 'results': list(results), 'extracts': list(extracts)}
+        return ToolResult("web_search", data, self.render_search)
+    
+    @staticmethod
+    def render_search(data):
+        """Fragmentos del texto de una búsqueda (se unen una sola vez al mostrarla)"""
+        local = " (índice local)" if data['source'] == "index" else ""
+        yield f"🔍 BÚSQUEDA{local}: {data['query']}\n" + "="*50 + "\n"
+        
+        # Búsqueda profunda: los extractos van primero, son lo que más aporta al modelo
+        if data['extracts']:
+            yield "📚 EXTRACTOS RELEVANTES:"
+            for extract in data['extracts']:
+                yield f"\n\n[{extract['url']}]\n{extract['text']}"
+            yield "\n\n"
+        
+        for i, result in enumerate(data['results'], 1):
+            yield (f"\n📄 RESULTADO {i}:\n"
+                   f"🔗 Título: {result['title']}\n"
+                   f"📝 Contenido: {result['body']}\n"
+                   f"🌐 URL: {result['url']}\n"
+                   + "-" * 30 + "\n")
+    
+    def _revalidate_search(self, query, max_results, cache_key):
+        """Refresca en segundo plano una búsqueda caducada (una sola vez a la vez por clave)"""
+        with self._search_lock:
+            if cache_key in self._revalidating:
+                return
+            self._revalidating.add(cache_key)
+        
+        def refresh():
+            try:
+                self._search_uncached(query, max_results, cache_key)
+            finally:
+                with self._search_lock:
+                    self._revalidating.discard(cache_key)
+        
+        threading.Thread(target=refresh, name="search-revalidate", daemon=True).start()
+    
+    def _search_uncached(self, query, max_results, cache_key=None):
+        """Consulta DuckDuckGo y guarda el resultado en la caché si hubo resultados"""
+        if not self.ensure_internet():
+            return self._offline_search(query, max_results, f"❌ Sin conexión a internet: no se puede buscar '{query}'")
+        
         try:
-            with DDGS() as ddgs:
-                results = []
-                for r in ddgs.text(query, max_results=max_results):
-                    results.append({
-                        'title': r['title'],
-                        'body': r['body'][:400] + '...' if len(r['body']) > 400 else r['body'],
-                        'url': r['href']
-                    })
+            # Cliente del pool: búsquedas seguidas reutilizan la conexión abierta
+            results = []
+            for r in self.search_pool.text(query, max_results=max_results):
+                if self.search_index:
+                    self.search_index.add(r['href'], r['title'], r['body'])
+                results.append({
+                    'title': r['title'],
+                    'body': r['body'][:400] + '...' if len(r['body']) > 400 else r['body'],
+                    'url': r['href']
+                })
+            
+            if results:
+                extracts = []
+                if self.deep_search:
+                    # La búsqueda profunda es opcional: si falla se devuelven los fragmentos de DDG
+                    try:
+                        extracts = self.deep_extracts(query, results[:self.deep_search])
+                    except Exception as e:
+                        if self.verbose:
+                            self.print_message(f"Búsqueda profunda omitida: {str(e)}", "warning")
+                
+                # Se cachean los datos, no el texto: consultas equivalentes muestran su propia cabecera
+                if cache_key:
+                    self.search_cache.put(cache_key, json.dumps({'results': results, 'extracts': extracts},
+                                                                ensure_ascii=False))
+                return self.search_result(query, "web", results, extracts)
+            else:
+                return f"❌ No se encontraron resultados para: {query}"
                 
-                if results:
-                    # Formatear resultados de manera más legible
-                    formatted_results = f"🔍 BÚSQUEDA: {query}\n" + "="*50 + "\n"
-                    
-                    for i, result in enumerate(results, 1):
-                        formatted_results += f"\n📄 RESULTADO {i}:\n"
-                        formatted_results += f"🔗 Título: {result['title']}\n"
-                        formatted_results += f"📝 Contenido: {result['body']}\n"
-                        formatted_results += f"🌐 URL: {result['url']}\n"
-                        formatted_results += "-" * 30 + "\n"
-                    
-                    return formatted_results
-                else:
-                    return f"❌ No se encontraron resultados para: {query}"
-                    
         except Exception as e:
-            return f"❌ Error en búsqueda web: {str(e)}"
+            return self._offline_search(query, max_results, f"❌ Error en búsqueda web: {str(e)}")
+    
+    def deep_extracts(self, query, results):
+        """Fragmentos más relevantes de las páginas de `results`, dentro de DEEP_SEARCH_TOKEN_BUDGET
+        
+        Returns:
+            [{'url', 'text'}, ...] en el orden en que aparecen en las páginas
+        """
+        chunks, sources = [], []
+        urls = [result['url'] for result in results]
+        for result, html in zip(results, self.page_fetcher.fetch_all(urls)):
+            if html:
+                url, text = result['url'], extract_main_text(html)
+                if self.search_index:
+                    self.search_index.add(url, result['title'], text[:SEARCH_INDEX_PAGE_CHARS])
+                for chunk in chunk_text(text):
+                    chunks.append(chunk)
+                    sources.append(url)
+        
+        selected, budget = [], DEEP_SEARCH_TOKEN_BUDGET
+        for index in rank_chunks(query, chunks):
+            cost = estimate_tokens(chunks[index])
+            if cost > budget:
+                continue
+            budget -= cost
+            selected.append(index)
+        
+        # Orden de aparición en las páginas para que el texto se lea con sentido
+        return [{'url': sources[index], 'text': chunks[index]} for index in sorted(selected)]
     
     def calculator(self, expression):
         """Calculadora avanzada con más funciones"""
@@ -222,7 +2416,8 @@ class OpenSourceAgent:
             
             # Evaluación segura
             result = eval(expression, {"__builtins__": {}}, {})
-            return f"🧮 CÁLCULO: {expression.replace('**', '^')}\n✅ Resultado: {result}"
+            return ToolResult("calculator", {'expression': expression.replace('**', '^'), 'result': result},
+                              lambda data: f"🧮 CÁLCULO: {data['expression']}\n✅ Resultado: {data['result']}")
             
         except ZeroDivisionError:
             return "❌ Error: División por cero"
@@ -316,195 +2511,815 @@ class OpenSourceAgent:
     def get_time(self):
         """Obtiene información de tiempo completa"""
         now = datetime.now()
-        return f"""🕐 INFORMACIÓN DE TIEMPO:
-📅 Fecha y hora: {now.strftime("%Y-%m-%d %H:%M:%S")}
-📆 Día de la semana: {now.strftime("%A")}
-📊 Semana del año: {now.isocalendar()[1]}
-⏱️ Timestamp Unix: {int(now.timestamp())}"""
+        data = {
+            'datetime': now.strftime("%Y-%m-%d %H:%M:%S"),
+            'weekday': now.strftime("%A"),
+            'week': now.isocalendar()[1],
+            'timestamp': int(now.timestamp())
+        }
+        return ToolResult("get_time", data, lambda data: f"""🕐 INFORMACIÓN DE TIEMPO:
+📅 Fecha y hora: {data['datetime']}
+📆 Día de la semana: {data['weekday']}
+📊 Semana del año: {data['week']}
+⏱️ Timestamp Unix: {data['timestamp']}""")
     
     def get_system_info(self):
         """Obtiene información del sistema"""
         try:
             import platform
             
-            info = f"""💻 INFORMACIÓN DEL SISTEMA:
-🖥️ OS: {platform.system()} {platform.release()}
-🏗️ Arquitectura: {platform.architecture()[0]}
-⚙️ Procesador: {platform.processor()}
-🐍 Python: {platform.python_version()}"""
+            data = {
+                'os': f"{platform.system()} {platform.release()}",
+                'architecture': platform.architecture()[0],
+                'processor': platform.processor(),
+                'python': platform.python_version()
+            }
             
             try:
                 import psutil
-                info += f"""
-🔧 CPU: {psutil.cpu_count()} cores
-💾 RAM: {psutil.virtual_memory().total // (1024**3)} GB total
-📊 Uso RAM: {psutil.virtual_memory().percent}%"""
+                memory = psutil.virtual_memory()
+                data.update(cpu_count=psutil.cpu_count(), ram_gb=memory.total // (1024**3),
+                            ram_percent=memory.percent)
             except ImportError:
-                info += "\n💡 Instala 'psutil' para más detalles del sistema"
+                pass
             
-            return info
+            return ToolResult("system_info", data, self.render_system_info)
         except Exception as e:
             return f"❌ Error obteniendo información del sistema: {str(e)}"
     
+    @staticmethod
+    def render_system_info(data):
+        yield f"""💻 INFORMACIÓN DEL SISTEMA:
+🖥️ OS: {data['os']}
+🏗️ Arquitectura: {data['architecture']}
+⚙️ Procesador: {data['processor']}
+🐍 Python: {data['python']}"""
+        if 'cpu_count' in data:
+            yield f"""
+🔧 CPU: {data['cpu_count']} cores
+💾 RAM: {data['ram_gb']} GB total
+📊 Uso RAM: {data['ram_percent']}%"""
+        else:
+            yield "\n💡 Instala 'psutil' para más detalles del sistema"
+    
     def get_weather(self, city=""):
         """Obtiene información del clima (usando API gratuita)"""
+        # Detectar ubicación automáticamente si no se indica ciudad
+        city = city or "auto"
+        cached = self.cached_weather(city)
+        if cached:
+            return self.weather_result(cached)
+        
+        if not self.weather_local and not self.ensure_internet():
+            return "❌ Sin conexión a internet: no se puede consultar el clima"
+        
         try:
-            # Usar wttr.in - servicio gratuito de clima
-            if not city:
-                city = "auto"  # Detectar ubicación automáticamente
-            
-            url = f"https://wttr.in/{city}?format=j1"
-            response = requests.get(url, timeout=10)
+            # Usar wttr.in - servicio gratuito de clima (sesión compartida: conexión reutilizada)
+            response = self.weather_session.get(self.weather_url(city), timeout=WEATHER_TIMEOUT)
             
             if response.status_code == 200:
-                data = response.json()
-                current = data['current_condition'][0]
-                location = data.get('nearest_area', [{}])[0]
-                
-                weather_info = f"""🌤️ CLIMA EN {city.upper()}:
-📍 Ubicación: {location.get('areaName', [{}])[0].get('value', 'Desconocida')}
-🌡️ Temperatura: {current['temp_C']}°C ({current['temp_F']}°F)
-☁️ Condición: {current['weatherDesc'][0]['value']}
-💧 Humedad: {current['humidity']}%
-💨 Viento: {current['windspeedKmph']} km/h
-👁️ Visibilidad: {current['visibility']} km"""
-                
-                return weather_info
+                return self.weather_result(self.store_weather(city, self.parse_weather(city, response.json())))
             else:
                 return f"❌ No se pudo obtener información del clima para: {city}"
                 
         except Exception as e:
             return f"❌ Error al obtener clima: {str(e)}"
     
-    def parse_tool_call(self, response):
-        """Extrae llamadas a herramientas de manera más robusta"""
-        patterns = [
-            r'USE_TOOL:\s*(\w+)\((.*?)\)',
-            r'TOOL:\s*(\w+)\((.*?)\)',
-            r'CALL:\s*(\w+)\((.*?)\)',
-            r'USAR:\s*(\w+)\((.*?)\)'
-        ]
+    def get_weather_batch(self, cities):
+        """Clima de varias ciudades consultadas en paralelo (resultados en el mismo orden)
         
-        matches = []
-        for pattern in patterns:
-            matches.extend(re.findall(pattern, response, re.IGNORECASE | re.DOTALL))
+        Las ciudades repetidas se consultan una vez y las que están en la
+        caché no generan peticiones.
+        """
+        unique = {self._weather_key(city or "auto"): city or "auto" for city in reversed(cities)}
+        if not unique:
+            return []
+        with futures.ThreadPoolExecutor(max_workers=min(len(unique), WEATHER_WORKERS),
+                                thread_name_prefix="weather") as pool:
+            results = dict(zip(unique, pool.map(self.get_weather, unique.values())))
+        return [results[self._weather_key(city or "auto")] for city in cities]
+    
+    @property
+    def weather_session(self):
+        """Sesión HTTP del clima, con tantas conexiones como consultas simultáneas"""
+        with self._weather_lock:
+            if self._weather_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=WEATHER_WORKERS)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._weather_session = session
+            return self._weather_session
+    
+    @staticmethod
+    def _weather_key(city):
+        return " ".join(strip_accents(city.casefold()).split())
+    
+    def cached_weather(self, city):
+        """Datos del clima de `city` si se consultaron hace menos de weather_cache_ttl segundos"""
+        with self._weather_lock:
+            entry = self._weather_cache.get(self._weather_key(city))
+        if entry and time.monotonic() - entry[1] < self.weather_cache_ttl:
+            return entry[0]
+        return None
+    
+    def store_weather(self, city, weather):
+        if self.weather_cache_ttl > 0:
+            with self._weather_lock:
+                self._weather_cache[self._weather_key(city)] = (weather, time.monotonic())
+        return weather
+    
+    def weather_url(self, city):
+        return f"{self.weather_base}/{city}?format=j1"
+    
+    @staticmethod
+    def parse_weather(city, data):
+        """Condiciones actuales de la respuesta j1 (el pronóstico de varios días se descarta)"""
+        current = data['current_condition'][0]
+        location = data.get('nearest_area', [{}])[0]
         
-        return matches
+        return {
+            'city': city,
+            'location': location.get('areaName', [{}])[0].get('value', 'Desconocida'),
+            'temp_c': current['temp_C'],
+            'temp_f': current['temp_F'],
+            'condition': current['weatherDesc'][0]['value'],
+            'humidity': current['humidity'],
+            'wind_kmph': current['windspeedKmph'],
+            'visibility_km': current['visibility']
+        }
+    
+    @staticmethod
+    def weather_result(weather):
+        return ToolResult("weather", weather, lambda w: f"""🌤️ CLIMA EN {w['city'].upper()}:
+📍 Ubicación: {w['location']}
+🌡️ Temperatura: {w['temp_c']}°C ({w['temp_f']}°F)
+☁️ Condición: {w['condition']}
+💧 Humedad: {w['humidity']}%
+💨 Viento: {w['wind_kmph']} km/h
+👁️ Visibilidad: {w['visibility_km']} km""")
+    
+    def parse_tool_call(self, response):
+        """Extrae llamadas a herramientas en una sola pasada (ver ToolCallScanner)"""
+        return parse_tool_calls(response)
+    
+    def describe_tool(self, name):
+        """Línea de documentación de una herramienta para el system prompt"""
+        if name in TOOL_DESCRIPTIONS:
+            params, description = TOOL_DESCRIPTIONS[name]
+        else:
+            # Herramientas personalizadas: firma y primera línea del docstring
+            func = self.tools[name]
+            params = ", ".join(inspect.signature(func).parameters)
+            description = (inspect.getdoc(func) or "").split("\n")[0]
+        return f"• {name}({params}): {description}"
     
     def create_enhanced_system_prompt(self):
-        """Crea un system prompt optimizado para respuestas directas"""
-        return f"""Eres un asistente de IA avanzado que proporciona respuestas directas y completas usando herramientas especializadas.
+        """Crea un system prompt optimizado para respuestas directas
+        
+        La parte fija se construye una vez por conjunto de herramientas y no
+        cambia entre turnos ni entre procesos, de modo que Ollama puede
+        reutilizar su caché de prefijo. Lo volátil (la fecha) va al final.
+        """
+        tools_key = tuple(self.tools)
+        if self._system_prompt_cache is None or self._system_prompt_cache[0] != tools_key:
+            tool_lines = "\n".join(self.describe_tool(name) for name in self.tools)
+            self._system_prompt_cache = (tools_key, f"""Eres un asistente de IA avanzado que proporciona respuestas directas y completas usando herramientas especializadas.
 
 HERRAMIENTAS DISPONIBLES:
-• web_search(query): Buscar información actualizada en internet
-• calculator(expression): Realizar cálculos matemáticos
-• file_operations(operation, filename, content): Manejar archivos
-• python_code(code): Ejecutar código Python
-• get_time(): Obtener información de tiempo
-• system_info(): Información del sistema
-• weather(city): Información del clima
+{tool_lines}
 
 FORMATO PARA USAR HERRAMIENTAS:
 USE_TOOL: nombre_herramienta(argumentos)
 
-REGLAS IMPORTANTES:
-1. Proporciona respuestas DIRECTAS e INFORMATIVAS
-2. NO hagas preguntas innecesarias al usuario
-3. Usa las herramientas automáticamente cuando sean necesarias
-4. Presenta la información de forma clara y organizada
-5. Incluye detalles relevantes sin ser redundante
+{SYSTEM_PROMPT_RULES}
 
 EJEMPLOS:
 - Para "busca información sobre IA": USE_TOOL: web_search("inteligencia artificial 2025")
 - Para "¿cuánto es 15 * 23?": USE_TOOL: calculator("15 * 23")
 - Para "¿qué hora es?": USE_TOOL: get_time()
 
-Fecha actual: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA.""")
+        
+        # Sección volátil: solo la fecha, para que el prefijo cambie como mucho una vez al día
+        return f"{self._system_prompt_cache[1]}\n\nFecha actual: {datetime.now().strftime('%Y-%m-%d')}"
+    
+    def create_native_system_prompt(self):
+        """System prompt del modo de herramientas nativo
+        
+        Las herramientas viajan como definiciones JSON en `tools`, así que el
+        prompt no necesita documentarlas ni incluir ejemplos de formato.
+        """
+        return f"""Eres un asistente de IA avanzado que proporciona respuestas directas y completas usando las herramientas disponibles.
+
+{SYSTEM_PROMPT_RULES}
 
-RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA."""
+RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA.
+
+Fecha actual: {datetime.now().strftime('%Y-%m-%d')}"""
+    
+    def tool_schemas(self):
+        """Definiciones JSON-schema de las herramientas para la API de chat de Ollama"""
+        tools_key = tuple(self.tools)
+        if self._tool_schema_cache is not None and self._tool_schema_cache[0] == tools_key:
+            return self._tool_schema_cache[1]
+        
+        schemas = []
+        for name, func in self.tools.items():
+            properties, required = {}, []
+            for param in inspect.signature(func).parameters.values():
+                if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                    continue
+                is_int = isinstance(param.default, int) and not isinstance(param.default, bool)
+                properties[param.name] = {"type": "integer" if is_int else "string"}
+                if param.default is param.empty:
+                    required.append(param.name)
+            
+            if name in TOOL_DESCRIPTIONS:
+                description = TOOL_DESCRIPTIONS[name][1]
+            else:
+                description = (inspect.getdoc(func) or "").split("\n")[0]
+            
+            schemas.append({
+                "type": "function",
+                "function": {
+                    "name": name,
+                    "description": description,
+                    "parameters": {"type": "object", "properties": properties, "required": required}
+                }
+            })
+        
+        self._tool_schema_cache = (tools_key, schemas)
+        return schemas
+    
+    def plan_direct_tool(self, user_query):
+        """Detecta consultas obvias que se responden con una herramienta sin usar el modelo
+        
+        Returns:
+            (nombre_herramienta, argumentos) o None si la consulta debe ir al modelo
+        """
+        # Detectar si necesita herramientas automáticamente (una sola pasada)
+        intent = self.router.route(user_query)
+        if intent is None and self.semantic_router:
+            intent = self.semantic_intent(user_query)
+        
+        if intent == "web_search":
+            # Extraer términos de búsqueda
+            search_terms = self.extract_search_terms(user_query)
+            if search_terms:
+                return "web_search", (search_terms,)
+        
+        elif intent == "calculator":
+            # Buscar expresión matemática
+            calc_expr = self.extract_math_expression(user_query)
+            if calc_expr:
+                return "calculator", (calc_expr,)
+        
+        elif intent == "get_time":
+            return "get_time", ()
+        
+        elif intent == "weather":
+            return "weather", (self.extract_city_from_query(user_query),)
+        
+        return None
     
-    def process_query(self, user_query):
-        """Procesa una consulta de manera optimizada para respuestas directas"""
+    def semantic_intent(self, user_query):
+        """Herramienta según el enrutador semántico (None si falla: se desactiva)"""
         try:
-            # DETECCIÓN DIRECTA DE COMANDOS DE HERRAMIENTAS
-            if user_query.strip().startswith("USE_TOOL:"):
-                return self.execute_direct_tool_command(user_query)
+            intent = self.semantic_router.route(user_query)
+        except Exception as e:
+            self.print_message(f"Enrutador semántico desactivado: {str(e)}", "warning")
+            self.semantic_router = None
+            return None
+        if self.verbose and intent:
+            self.print_message(f"Enrutado semántico a {intent} ({self.semantic_router.last_ms:.1f} ms)", "info")
+        return intent
+    
+    @staticmethod
+    def extract_search_terms(user_query):
+        """Términos de búsqueda sin las palabras de la orden ni las vacías de los extremos
+        
+        "busca información sobre la historia de Roma" → "historia de Roma".
+        Si la consulta tiene un texto entre comillas, se busca ese texto.
+        """
+        quoted = re.search(r'["“«]([^"”»]+)["”»]', user_query)
+        if quoted:
+            return quoted.group(1).strip()
+        
+        words = [word.strip("¿?¡!.,;:'\"") for word in user_query.split()]
+        words = [word for word in words if word and word.lower() not in SEARCH_COMMAND_WORDS]
+        # Las palabras vacías solo se quitan de los extremos: "historia de Roma" se mantiene
+        while words and words[0].lower() in SEARCH_STOP_WORDS:
+            words.pop(0)
+        while words and words[-1].lower() in SEARCH_STOP_WORDS:
+            words.pop()
+        return " ".join(words)
+    
+    @staticmethod
+    def extract_math_expression(user_query):
+        """Expresión aritmética más larga y válida de la consulta, lista para `calculator`
+        
+        Reconoce operadores en palabras ("3 por 4", "10 dividido entre 2"),
+        coma decimal, punto de miles ("1.000") y porcentajes ("15% de 200").
+        Devuelve None si no hay ninguna operación binaria o si la operación
+        está pegada a algo que no entiende ("sqrt(16)", "1e10", "x + 2 = 5"):
+        en ese caso la consulta la responde el modelo.
+        """
+        query = MATH_PERCENT_OF.sub(r'(\1*\2/100)', MATH_NOT_EXPRESSION.sub(" ", user_query.lower()))
+        
+        # Tramos consecutivos de números y operadores: [(token, inicio, fin, símbolo), ...]
+        runs, run = [], []
+        for match in MATH_TOKEN.finditer(query):
+            kind, token = match.lastgroup, match.group()
+            if kind == "other":
+                if run:
+                    runs.append(run)
+                run = []
+                continue
+            if kind == "num":
+                if re.fullmatch(r'\d{1,3}(?:\.\d{3})+(?:,\d+)?', token):
+                    token = token.replace(".", "")
+                token = token.replace(",", ".")
+            else:
+                token = MATH_WORDS.get(" ".join(token.split()), token)
+            run.append((token, match.start(), match.end(), kind == "op"))
+        if run:
+            runs.append(run)
+        
+        def is_valid(tokens, i, j):
+            span = tokens[i:j]
+            # Una letra pegada al tramo es una función, variable o notación que no se evalúa
+            start, end = span[0][1], span[-1][2]
+            if (start > 0 and (query[start - 1].isalnum() or query[start - 1] in "_.")) or \
+               (end < len(query) and (query[end].isalnum() or query[end] in "_.")):
+                return False
+            # Un operador escrito junto al tramo significa que la operación sigue con algo
+            # que se descartó ("x + 2 * 3"); los operadores en palabras ("por favor") no cuentan
+            if (i > 0 and tokens[i - 1][3]) or (j < len(tokens) and tokens[j][3]):
+                return False
+            # Tras un operador en palabras, un signo inicial indica que "x", "por"... era
+            # un operando ("x - 2 * 3"), no una operación
+            if i > 0 and span[0][3] and span[0][0] != "(":
+                return False
+            expression = "".join(token for token, _, _, _ in span)
+            try:
+                tree = ast.parse(expression.replace("^", "**"), mode="eval")
+            except SyntaxError:
+                return False
+            nodes = list(ast.walk(tree))
+            return (all(isinstance(node, MATH_NODES) for node in nodes)
+                    and any(isinstance(node, ast.BinOp) for node in nodes))
+        
+        best = None
+        for tokens in runs:
+            # Del tramo más largo al más corto: gana el primero que sea válido
+            for length in range(len(tokens), 0, -1):
+                if best and length <= len(best):
+                    break
+                span = next((tokens[i:i + length] for i in range(len(tokens) - length + 1)
+                             if is_valid(tokens, i, i + length)), None)
+                if span:
+                    best = span
+                    break
+        return "".join(token for token, _, _, _ in best) if best else None
+    
+    @staticmethod
+    def extract_city_from_query(user_query):
+        """Ciudad mencionada en la consulta ("" = ubicación automática de wttr.in)
+        
+        Primero se busca en el gazetteer local (sin tildes ni mayúsculas);
+        si no aparece, se toma el nombre propio que sigue a "en"/"de"/"in".
+        """
+        normalized = strip_accents(user_query.lower())
+        match = CITY_GAZETTEER_PATTERN.search(normalized)
+        if match:
+            return CITY_GAZETTEER[" ".join(match.group().split())]
+        
+        match = CITY_AFTER_PREPOSITION.search(user_query)
+        return match.group(1).strip() if match else ""
+    
+    def execute_direct_tool_command(self, command):
+        """Ejecuta un comando escrito por el usuario: USE_TOOL: herramienta(argumentos)"""
+        tool_calls = parse_tool_calls(command)
+        if not tool_calls:
+            return "❌ Formato no válido. Usa: USE_TOOL: herramienta(argumentos)"
+        
+        unknown = [call.name for call in tool_calls if call.name not in self.tools]
+        if unknown:
+            return (f"❌ Herramienta desconocida: {', '.join(unknown)}\n"
+                    f"🔧 Disponibles: {', '.join(self.tools)}")
+        
+        if len(tool_calls) == 1:
+            results = [self.execute_tool_safely(*tool_calls[0])]
+        else:
+            results = self.run_tool_calls(tool_calls)
+        parts = []
+        for call, result in zip(tool_calls, results):
+            positional, _ = decode_tool_args(call.args)
+            parts.append(self.format_direct_result(call.name, positional or [call.args], result))
+        if len(parts) == 1:
+            return parts[0]
+        return ToolResult(None, {'results': [result_to_dict(part) for part in parts]},
+                          lambda _: "\n\n".join(map(str, parts)))
+    
+    @staticmethod
+    def format_direct_result(tool_name, args, result):
+        """Presenta el resultado de una herramienta ejecutada sin el modelo"""
+        if tool_name == "web_search":
+            return ToolResult(tool_name, getattr(result, "data", None), lambda _: (
+                "🔍 BÚSQUEDA EJECUTADA DIRECTAMENTE:\n\n", result, f"\n\n💡 Información encontrada sobre: {args[0]}"),
+                ok=isinstance(result, ToolResult))
+        return result
+    
+    @staticmethod
+    def format_tool_results(response, tool_results):
+        """Agrega a la respuesta del modelo la salida de las herramientas que pidió"""
+        return AgentResponse(response, tool_results)
+    
+    @staticmethod
+    def record_turn(window, history, user_query, final_response, tool_calls, steps=None):
+        """Guarda un turno en la ventana de contexto y en el historial"""
+        final_response = str(final_response)
+        window.add_turn(user_query, final_response)
+        history.append({
+            'user': user_query,
+            'assistant': final_response,
+            'timestamp': datetime.now().isoformat(),
+            'tools_used': [tool for tool, _ in tool_calls],
+            'steps': steps or []
+        })
+    
+    def known_tool_calls(self, response):
+        """Llamadas a herramientas registradas dentro de una respuesta del modelo"""
+        return [(tool_name, args) for tool_name, args in self.parse_tool_call(response) if tool_name in self.tools]
+    
+    @staticmethod
+    def clip_observation(tool_name, result):
+        """Texto de un resultado recortado al límite de su herramienta"""
+        result = str(result)
+        limit = OBSERVATION_CHAR_LIMITS.get(tool_name, OBSERVATION_CHAR_LIMIT)
+        if len(result) > limit:
+            result = result[:limit] + "…"
+        return result
+    
+    @staticmethod
+    def build_observation(tool_calls, tool_results):
+        """Mensaje con los resultados de las herramientas para el siguiente paso del modelo"""
+        parts = ["RESULTADOS DE LAS HERRAMIENTAS:"]
+        for (tool_name, args), result in zip(tool_calls, tool_results):
+            parts.append(f"[{tool_name}({args})]\n{OpenSourceAgent.clip_observation(tool_name, result)}")
+        parts.append("Usa estos resultados para responder al usuario. "
+                     "Solo usa otra herramienta si es imprescindible.")
+        return "\n\n".join(parts)
+    
+    def log_steps(self, steps):
+        """Muestra el tiempo de cada paso del bucle en modo verbose"""
+        if self.verbose and len(steps) > 1:
+            for step in steps:
+                self.print_message(f"Paso {step['step']}: modelo {step['llm_ms']} ms, "
+                                   f"herramientas {step['tools_ms']} ms {step['tools']}", "info")
+    
+    def stream_tool_detector(self, on_token, speculation=None):
+        """Envuelve `on_token` para lanzar cada herramienta en cuanto su llamada se cierra
+        
+        Returns:
+            (callback para call_ollama, dict {ToolCall: resultado de submit} con lo ya lanzado)
+        """
+        scanner = ToolCallScanner()
+        started = {}
+        
+        def on_stream_token(token):
+            on_token(token)
+            for call in scanner.feed(token):
+                if call.name in self.tools and call not in started:
+                    started[call] = (self.claim_speculation(speculation, call.name, call.args)
+                                     or self.scheduler.submit(call.name, self._invoke_tool, call.name, call.args))
+        
+        return on_stream_token, started
+    
+    def execute_tool_safely(self, tool_name, args):
+        """Ejecuta una llamada del modelo con su timeout y devuelve el resultado o el error en texto
+        
+        Es el punto de entrada para una sola llamada; `run_tool_calls` hace
+        lo mismo con varias a la vez.
+        
+        Args:
+            tool_name: Nombre de la herramienta registrada
+            args: Argumentos tal como aparecen en la llamada, p. ej. '"Madrid", units="metric"'
+        """
+        if tool_name not in self.tools:
+            return f"❌ Herramienta desconocida: {tool_name}"
+        return self.scheduler.map([(tool_name, self._invoke_tool, (tool_name, args))])[0]
+    
+    def _invoke_tool(self, tool_name, args):
+        """Ejecuta una herramienta pedida por el modelo (dentro de un hilo del planificador)"""
+        positional, keywords = decode_tool_args(args)
+        return self.tools[tool_name](*positional, **keywords)
+    
+    def _invoke_tool_kwargs(self, tool_name, arguments):
+        """Ejecuta una herramienta con argumentos estructurados (tool calling nativo)"""
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments) if arguments.strip() else {}
+        return self.tools[tool_name](**arguments)
+    
+    def _scheduled_calls(self, tool_calls):
+        """Convierte las llamadas del modelo en tareas para el ToolScheduler"""
+        calls = []
+        for tool_name, args in tool_calls:
+            if tool_name in self.tools:
+                self.print_message(f"Ejecutando: {tool_name}({args})", "info")
+                calls.append((tool_name, self._invoke_tool, (tool_name, args)))
+        return calls
+    
+    def run_tool_calls(self, tool_calls, started=None):
+        """Ejecuta en paralelo las herramientas pedidas por el modelo
+        
+        Las llamadas independientes se solapan (la latencia total es la de
+        la más lenta); los resultados se devuelven en el orden original.
+        `started` son las llamadas ya lanzadas durante el streaming.
+        """
+        return self.scheduler.map(*self._tool_batch(tool_calls, started))
+    
+    def _tool_batch(self, tool_calls, started=None):
+        """(tareas, llamadas ya lanzadas) para ToolScheduler.map"""
+        started = started or {}
+        known = [call for call in tool_calls if call[0] in self.tools]
+        # Cada llamada ya lanzada se reutiliza una sola vez (puede repetirse en el texto)
+        early = [started.pop(call, None) for call in known]
+        return self._scheduled_calls(known), early
+    
+    def start_speculation(self, user_query):
+        """Lanza en segundo plano la herramienta de red que la consulta probablemente necesita
+        
+        Solo se especula si el enrutador duda (puntuación entre
+        SPECULATION_THRESHOLD y el umbral de ejecución directa) y si el
+        presupuesto de prefetches descartados no se ha agotado.
+        
+        Returns:
+            dict con la llamada en curso o None
+        """
+        if not self.speculative:
+            return None
+        if self.speculation_outcomes.count(False) >= SPECULATION_MAX_WASTED:
+            # Presupuesto agotado: la consulta cuenta como ronda sin prefetch para que la ventana avance
+            self.speculation_outcomes.append(None)
+            return None
+        
+        scores = self.router.scores(user_query)
+        candidates = [tool_name for tool_name in SPECULATIVE_TOOLS
+                      if SPECULATION_THRESHOLD <= scores.get(tool_name, 0) < self.router.threshold]
+        if not candidates:
+            return None
+        tool_name = max(candidates, key=scores.get)
+        
+        if tool_name == "web_search":
+            arg = self.extract_search_terms(user_query)
+        else:
+            arg = self.extract_city_from_query(user_query)
+        if not arg:
+            return None
+        
+        future, queue_deadline = self.scheduler.submit(tool_name, self.tools[tool_name], arg)
+        return {'tool': tool_name, 'arg': arg, 'future': future, 'queue_deadline': queue_deadline, 'used': False}
+    
+    def claim_speculation(self, speculation, tool_name, args):
+        """(Future, límite de espera) del prefetch si el modelo pide la misma herramienta con argumentos parecidos"""
+        if not speculation or speculation['used'] or speculation['tool'] != tool_name:
+            return None
+        
+        if isinstance(args, str):
+            positional, keywords = decode_tool_args(args)
+        else:
+            positional, keywords = [], args
+        arg = positional[0] if positional else next(iter(keywords.values()), None)
+        if not isinstance(arg, str):
+            return None
+        
+        wanted = set(re.findall(r'\w+', strip_accents(arg.lower())))
+        fetched = set(re.findall(r'\w+', strip_accents(speculation['arg'].lower())))
+        if not wanted or len(wanted & fetched) / len(wanted | fetched) < SPECULATION_MATCH:
+            return None
+        
+        speculation['used'] = True
+        return speculation['future'], speculation['queue_deadline']
+    
+    def finish_speculation(self, speculation):
+        """Anota si el prefetch se aprovechó (los descartados consumen presupuesto)"""
+        if not speculation:
+            return
+        self.speculation_outcomes.append(speculation['used'])
+        if self.verbose:
+            outcome = "aprovechado" if speculation['used'] else "descartado"
+            self.print_message(f"Prefetch de {speculation['tool']}({speculation['arg']}) {outcome}", "info")
+    
+    def _text_steps(self, user_query, window, on_token=None, speculation=None):
+        """Bucle ReAct con el protocolo de texto USE_TOOL
+        
+        Es un generador sin E/S que comparten el agente síncrono y el
+        asíncrono (ver _run_steps): pide ('model', argumentos de call_ollama)
+        y ('tools', argumentos de ToolScheduler.map) y recibe el resultado.
+        
+        Returns:
+            (respuesta final, llamadas ejecutadas, tiempos por paso) o el texto
+            de error del modelo
+        """
+        # Modo chat: incluir los turnos anteriores dentro del presupuesto de contexto
+        system_prompt = self.create_enhanced_system_prompt()
+        messages = window.build_messages(system_prompt, user_query)
+        kv_session = window if self.kv_context else None
+        prompt = user_query
+        all_calls, steps = [], []
+        
+        # Bucle ReAct: modelo → herramientas → observación → modelo. Cada paso
+        # solo añade la observación: el prefijo (contexto KV o mensajes) se reutiliza
+        for step in range(1, self.max_steps + 1):
+            started = time.perf_counter()
+            stream_callback, early_calls = None, {}
+            if on_token:
+                if step > 1:
+                    on_token("\n\n")
+                # Las herramientas arrancan en cuanto su llamada aparece en el stream
+                stream_callback, early_calls = self.stream_tool_detector(on_token, speculation)
+            response = yield "model", {'prompt': prompt, 'system_prompt': system_prompt,
+                                       'on_token': stream_callback, 'messages': messages,
+                                       'kv_session': kv_session}
+            llm_ms = round((time.perf_counter() - started) * 1000)
+            
+            if "Error:" in response:
+                return response
+            
+            # Respuesta final: el modelo ya no pide herramientas
+            tool_calls = self.known_tool_calls(response)
+            if not tool_calls:
+                final_response = self.format_tool_results(response, [])
+                steps.append({'step': step, 'llm_ms': llm_ms, 'tools_ms': 0, 'tools': []})
+                break
+            
+            # Buscar y ejecutar herramientas en la respuesta del modelo (reutilizando el prefetch)
+            for call in tool_calls:
+                if call not in early_calls:
+                    claimed = self.claim_speculation(speculation, *call)
+                    if claimed:
+                        early_calls[call] = claimed
+            started = time.perf_counter()
+            tool_results = yield "tools", self._tool_batch(tool_calls, early_calls)
+            all_calls.extend(tool_calls)
+            steps.append({'step': step, 'llm_ms': llm_ms,
+                          'tools_ms': round((time.perf_counter() - started) * 1000),
+                          'tools': [tool_name for tool_name, _ in tool_calls]})
             
-            # Detectar si necesita herramientas automáticamente
-            needs_search = any(keyword in user_query.lower() for keyword in [
-                'busca', 'buscar', 'información', 'noticias', 'actualiza', 'último',
-                'search', 'find', 'what is', 'qué es', 'cómo está', 'últimas noticias',
-                'que es', 'define', 'definición'
-            ])
+            # Presupuesto agotado: devolver la respuesta con los resultados adjuntos
+            final_response = self.format_tool_results(response, tool_results)
             
-            needs_calc = any(keyword in user_query.lower() for keyword in [
-                'calcula', 'calculate', 'cuánto es', 'how much', 'suma', 'resta', 
-                'multiplica', 'divide', '+', '-', '*', '/', '=', 'math'
-            ])
+            prompt = self.build_observation(tool_calls, tool_results)
+            messages = messages + [{"role": "assistant", "content": response},
+                                   {"role": "user", "content": prompt}]
+        
+        return final_response, all_calls, steps
+    
+    def _native_steps(self, user_query, window, on_token=None, speculation=None):
+        """Bucle ReAct con tool calling nativo de Ollama (`tools` en /api/chat)
+        
+        El modelo devuelve las llamadas como JSON estructurado, sin parsear
+        texto. Mismo protocolo que _text_steps, con ('native', argumentos de
+        call_ollama_native); devuelve None si el modelo no soporta
+        herramientas o la API HTTP no responde, para recurrir al protocolo
+        de texto.
+        """
+        messages = window.build_messages(self.create_native_system_prompt(), user_query)
+        all_calls, steps = [], []
+        
+        for step in range(1, self.max_steps + 1):
+            started = time.perf_counter()
+            if on_token and step > 1:
+                on_token("\n\n")
+            reply = yield "native", (messages, on_token)
+            if reply is None:
+                if self.use_http:
+                    self.native_tools_supported = False
+                    self.print_message(f"{self.model_name} no soporta herramientas nativas, usando modo texto",
+                                       "warning")
+                return None
+            response, native_calls = reply
+            self.native_tools_supported = True
+            llm_ms = round((time.perf_counter() - started) * 1000)
+            
+            if response.startswith("Error:"):
+                return response
+            
+            calls = []
+            for native_call in native_calls:
+                function = native_call.get('function', {})
+                if function.get('name') in self.tools:
+                    calls.append((function['name'], function.get('arguments') or {}))
             
-            needs_time = any(keyword in user_query.lower() for keyword in [
-                'hora', 'time', 'fecha', 'date', 'qué hora', 'what time'
-            ])
+            if not calls:
+                final_response = self.format_tool_results(response, [])
+                steps.append({'step': step, 'llm_ms': llm_ms, 'tools_ms': 0, 'tools': []})
+                break
+            
+            started = time.perf_counter()
+            scheduled = []
+            for tool_name, arguments in calls:
+                self.print_message(f"Ejecutando: {tool_name}({arguments})", "info")
+                scheduled.append((tool_name, self._invoke_tool_kwargs, (tool_name, arguments)))
+            early = [self.claim_speculation(speculation, tool_name, arguments) for tool_name, arguments in calls]
+            tool_results = yield "tools", (scheduled, early)
+            
+            # Registrar las llamadas con la misma forma (nombre, args) que el modo texto
+            tool_calls = [(tool_name, arguments if isinstance(arguments, str)
+                           else json.dumps(arguments, ensure_ascii=False))
+                          for tool_name, arguments in calls]
+            all_calls.extend(tool_calls)
+            steps.append({'step': step, 'llm_ms': llm_ms,
+                          'tools_ms': round((time.perf_counter() - started) * 1000),
+                          'tools': [tool_name for tool_name, _ in calls]})
+            
+            final_response = self.format_tool_results(response, tool_results)
+            
+            messages = messages + [{"role": "assistant", "content": response, "tool_calls": native_calls}]
+            for (tool_name, _), result in zip(calls, tool_results):
+                messages.append({"role": "tool", "content": self.clip_observation(tool_name, result),
+                                 "tool_name": tool_name})
+        
+        return final_response, all_calls, steps
+    
+    def react_loops(self, user_query, window, on_token=None, speculation=None):
+        """Bucles ReAct en orden de preferencia: si uno devuelve None se usa el siguiente"""
+        if self.tool_mode != "text" and self.use_http and self.native_tools_supported is not False:
+            yield self._native_steps(user_query, window, on_token, speculation)
+        yield self._text_steps(user_query, window, on_token, speculation)
+    
+    def _run_steps(self, steps):
+        """Ejecuta un bucle ReAct atendiendo sus peticiones al modelo y a las herramientas"""
+        reply = None
+        while True:
+            try:
+                kind, request = steps.send(reply)
+            except StopIteration as done:
+                return done.value
             
-            needs_weather = any(keyword in user_query.lower() for keyword in [
-                'clima', 'weather', 'temperatura', 'lluvia', 'sol'
-            ])
+            if kind == "model":
+                reply = self.call_ollama(**request)
+            elif kind == "native":
+                try:
+                    reply = self.call_ollama_native(*request)
+                except ToolsNotSupportedError:
+                    reply = None
+            else:
+                reply = self.scheduler.map(*request)
+    
+    def process_query(self, user_query, on_token=None):
+        """Procesa una consulta de manera optimizada para respuestas directas
+        
+        Args:
+            user_query: Consulta del usuario
+            on_token: Callback opcional que recibe los tokens del modelo en streaming
+        
+        Returns:
+            La respuesta como texto (ver query_result para la versión estructurada)
+        """
+        return str(self.query_result(user_query, on_token))
+    
+    def query_result(self, user_query, on_token=None):
+        """Como process_query, pero devuelve el resultado estructurado sin renderizar
+        
+        Returns:
+            ToolResult (herramienta ejecutada directamente), AgentResponse
+            (respuesta del modelo con las herramientas que pidió, lista vacía
+            si no usó ninguna) o texto (errores)
+        """
+        try:
+            # DETECCIÓN DIRECTA DE COMANDOS DE HERRAMIENTAS
+            if user_query.strip().startswith("USE_TOOL:"):
+                return self.execute_direct_tool_command(user_query)
             
             # EJECUCIÓN DIRECTA DE HERRAMIENTAS CUANDO ES OBVIO
-            if needs_search:
-                # Extraer términos de búsqueda
-                search_terms = self.extract_search_terms(user_query)
-                if search_terms:
-                    search_result = self.web_search(search_terms)
-                    return f"🔍 BÚSQUEDA EJECUTADA DIRECTAMENTE:\n\n{search_result}\n\n💡 Información encontrada sobre: {search_terms}"
-            
-            elif needs_calc:
-                # Buscar expresión matemática
-                calc_expr = self.extract_math_expression(user_query)
-                if calc_expr:
-                    calc_result = self.calculator(calc_expr)
-                    return calc_result
-            
-            elif needs_time:
-                return self.get_time()
-            
-            elif needs_weather:
-                city = self.extract_city_from_query(user_query)
-                return self.get_weather(city)
+            plan = self.plan_direct_tool(user_query)
+            if plan:
+                tool_name, args = plan
+                return self.format_direct_result(tool_name, args, self.tools[tool_name](*args))
             
             # Si no es una consulta obvia de herramientas, usar el modelo normal
-            system_prompt = self.create_enhanced_system_prompt()
-            response = self.call_ollama(user_query, system_prompt)
-            
-            if "Error:" in response:
-                return response
+            # La herramienta probable se adelanta mientras el modelo genera
+            speculation = self.start_speculation(user_query)
+            try:
+                for steps in self.react_loops(user_query, self.window, on_token, speculation):
+                    outcome = self._run_steps(steps)
+                    if outcome is not None:
+                        break
+            finally:
+                self.finish_speculation(speculation)
             
-            # Buscar y ejecutar herramientas en la respuesta del modelo
-            tool_calls = self.parse_tool_call(response)
-            final_response = response
+            # Error del modelo: se devuelve tal cual, sin guardarlo en el historial
+            if isinstance(outcome, str):
+                return outcome
             
-            if tool_calls:
-                final_response += "\n\n" + "="*50 + "\n🔧 HERRAMIENTAS EJECUTADAS:\n" + "="*50
-                
-                for tool_name, args in tool_calls:
-                    if tool_name in self.tools:
-                        try:
-                            self.print_message(f"Ejecutando: {tool_name}({args})", "info")
-                            tool_result = self.execute_tool_safely(tool_name, args)
-                            final_response += f"\n\n{tool_result}"
-                            
-                        except Exception as e:
-                            error_msg = f"❌ Error ejecutando {tool_name}: {str(e)}"
-                            self.print_message(error_msg, "error")
-                            final_response += f"\n\n{error_msg}"
+            final_response, all_calls, steps = outcome
+            self.log_steps(steps)
             
             # Guardar en historial
-            self.conversation_history.append({
-                'user': user_query,
-                'assistant': final_response,
-                'timestamp': datetime.now().isoformat(),
-                'tools_used': [tool for tool, _ in tool_calls]
-            })
+            self.record_turn(self.window, self.conversation_history, user_query, final_response, all_calls, steps)
             
             return final_response
             
@@ -530,16 +3345,57 @@ RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA."""
             self.print_message(f"Error guardando conversación: {str(e)}", "error")
             return None
     
+    def process_query_live(self, user_query):
+        """Procesa una consulta mostrando los tokens del modelo en vivo"""
+        if get_console():
+            from rich.live import Live
+            from rich.text import Text
+            
+            # La vista en vivo es transitoria: al terminar se muestra la respuesta completa
+            text = Text("🤖 Pensando...", style="dim")
+            started = False
+            
+            with Live(text, console=console, refresh_per_second=12, transient=True):
+                def on_token(token):
+                    nonlocal started
+                    if not started:
+                        text.plain = ""
+                        text.style = ""
+                        started = True
+                    text.append(token)
+                
+                return self.process_query(user_query, on_token=on_token)
+        
+        # Sin Rich: imprimir los tokens directamente y luego lo que falte (herramientas)
+        print("\n🤖 Agente: ", end='', flush=True)
+        streamed = []
+        
+        def on_token(token):
+            streamed.append(token)
+            print(token, end='', flush=True)
+        
+        response = self.process_query(user_query, on_token=on_token)
+        streamed_text = "".join(streamed).strip()
+        if streamed_text.endswith(response):
+            print()
+        elif streamed_text and response.startswith(streamed_text):
+            print(response[len(streamed_text):])
+        else:
+            print(response if not streamed_text else f"\n{response}")
+        return response
+    
     def chat_loop(self):
         """Loop de conversación interactiva optimizado"""
         # Mensaje de bienvenida
-        if RICH_AVAILABLE and console:
+        if get_console():
+            from rich.panel import Panel
+            
             welcome_panel = Panel.fit(
                 """🤖 Agente IA Open Source v2.1 - OPTIMIZADO
 💡 Herramientas: web_search, calculator, file_ops, python_code, weather, system_info
 📁 Directorio de trabajo: agente_workspace/
 🚀 Respuestas directas sin preguntas innecesarias
-❌ Comandos: 'quit', 'save', 'help', 'clear'""",
+❌ Comandos: 'quit', 'save', 'help', 'clear', 'reset', 'stats'""",
                 title="[bold blue]Agente IA Optimizado[/bold blue]",
                 border_style="blue"
             )
@@ -548,7 +3404,7 @@ RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA."""
             print("🤖 Agente IA Open Source v2.1 - OPTIMIZADO")
             print("💡 Respuestas directas con herramientas automáticas")
             print("📁 Directorio de trabajo: agente_workspace/")
-            print("❌ Comandos: 'quit', 'save', 'help', 'clear'\n")
+            print("❌ Comandos: 'quit', 'save', 'help', 'clear', 'reset', 'stats'\n")
         
         while True:
             try:
@@ -576,6 +3432,8 @@ RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA."""
 • quit/exit - Salir del agente
 • save - Guardar conversación  
 • clear - Limpiar pantalla
+• reset - Olvidar el contexto de la conversación
+• stats - Latencia reciente de cada herramienta
 • help - Mostrar esta ayuda
 
 💡 EJEMPLOS DE CONSULTAS (RESPUESTAS DIRECTAS):
@@ -595,17 +3453,37 @@ RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA."""
                     os.system('cls' if os.name == 'nt' else 'clear')
                     continue
                 
+                elif user_input.lower() == 'reset':
+                    self.window.clear()
+                    self.print_message("Contexto de la conversación reiniciado", "success")
+                    continue
+                
+                elif user_input.lower() == 'stats':
+                    stats = self.scheduler.latency_stats()
+                    if not stats:
+                        self.print_message("Todavía no se ha ejecutado ninguna herramienta", "info")
+                    for tool_name, stat in sorted(stats.items()):
+                        self.print_message(f"{tool_name}: {stat['calls']} llamadas, media {stat['avg_ms']} ms, "
+                                           f"máximo {stat['max_ms']} ms, en cola {stat['avg_wait_ms']} ms",
+                                           "info")
+                    continue
+                
                 # Procesar consulta normal
-                response = self.process_query(user_input)
+                if self.stream:
+                    response = self.process_query_live(user_input)
+                else:
+                    response = self.process_query(user_input)
                 
                 # Mostrar respuesta
-                if RICH_AVAILABLE and console:
+                if get_console():
+                    from rich.panel import Panel
+                    
                     console.print("\n🤖 Agente:", style="bold blue")
                     if response.count('\n') > 10:  # Respuesta muy larga
                         console.print(Panel(response, border_style="blue", title="Respuesta Completa"))
                     else:
                         console.print(response)
-                else:
+                elif not self.stream:
                     print(f"\n🤖 Agente: {response}")
                 
             except KeyboardInterrupt:
@@ -619,6 +3497,318 @@ RESPONDE SIEMPRE DE FORMA DIRECTA Y COMPLETA."""
                 if self.verbose:
                     traceback.print_exc()
 
+class AsyncOllamaClient:
+    def __init__(self, base_url=None, timeout=120, max_connections=16):
+        """
+        Cliente asíncrono de la API de Ollama
+        
+        Usa httpx.AsyncClient si está instalado; si no, delega en
+        OllamaClient ejecutándolo en un hilo. Los errores de conexión y de
+        timeout se traducen a ConnectionError y TimeoutError.
+        
+        Args:
+            base_url: URL del servidor de Ollama (por defecto $OLLAMA_HOST)
+            timeout: Tiempo máximo de espera por petición en segundos
+            max_connections: Conexiones simultáneas del pool asíncrono
+        """
+        self.sync_client = OllamaClient(base_url, timeout)
+        self.base_url = self.sync_client.base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client = None
+    
+    async def _post(self, endpoint, payload):
+        if not HTTPX_AVAILABLE:
+            return await asyncio.to_thread(self._post_sync, endpoint, payload)
+        
+        import httpx
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections)
+            )
+        try:
+            response = await self._client.post(endpoint, json=payload)
+        except httpx.ConnectError as e:
+            raise ConnectionError(str(e)) from e
+        except httpx.TimeoutException as e:
+            raise TimeoutError(str(e)) from e
+        
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
+        return response.json()
+    
+    def _post_sync(self, endpoint, payload):
+        try:
+            return self.sync_client._post(endpoint, payload).json()
+        except requests.ConnectionError as e:
+            raise ConnectionError(str(e)) from e
+        except requests.Timeout as e:
+            raise TimeoutError(str(e)) from e
+    
+    async def generate(self, model, prompt, system=None, options=None, **extra):
+        """Llama a /api/generate y devuelve el JSON de la respuesta"""
+        payload = OllamaClient._generate_payload(model, prompt, system, options, False, extra)
+        return await self._post("/api/generate", payload)
+    
+    async def chat(self, model, messages, options=None, **extra):
+        """Llama a /api/chat y devuelve el JSON de la respuesta"""
+        payload = OllamaClient._chat_payload(model, messages, options, False, extra)
+        return await self._post("/api/chat", payload)
+    
+    async def aclose(self):
+        """Cierra las conexiones abiertas"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.sync_client.close()
+
+class ChatSession:
+    def __init__(self, context_length=DEFAULT_CONTEXT_LENGTH):
+        """Estado de una conversación: ventana de contexto, historial y candado de turnos"""
+        self.window = ConversationWindow(context_length)
+        self.history = []
+        self.lock = asyncio.Lock()
+
+class AsyncOpenSourceAgent:
+    def __init__(self, agent=None, max_concurrent_llm=4, **agent_kwargs):
+        """
+        Núcleo asíncrono del agente para atender muchas sesiones en un solo bucle de eventos
+        
+        Reutiliza la configuración y las herramientas de un OpenSourceAgent:
+        el modelo se llama con un cliente HTTP asíncrono, el clima con HTTP
+        asíncrono y el resto de herramientas (DuckDuckGo incluido) se
+        ejecutan en hilos para no bloquear el bucle.
+        
+        Args:
+            agent: OpenSourceAgent ya configurado (si no, se crea uno con `agent_kwargs`)
+            max_concurrent_llm: Llamadas simultáneas máximas al modelo
+            **agent_kwargs: Argumentos para crear el OpenSourceAgent
+        """
+        agent_kwargs.setdefault("skip_checks", True)
+        agent_kwargs.setdefault("verbose", False)
+        self.agent = agent or OpenSourceAgent(**agent_kwargs)
+        self.ollama = AsyncOllamaClient(self.agent.ollama.base_url)
+        self.max_concurrent_llm = max_concurrent_llm
+        self.sessions = {}
+        self._llm_semaphore = None
+        self._http = None
+    
+    def session(self, session_id):
+        """Devuelve (creándola si hace falta) la sesión de conversación indicada"""
+        if session_id not in self.sessions:
+            self.sessions[session_id] = ChatSession(self.agent.window.context_length)
+        return self.sessions[session_id]
+    
+    async def _call_ollama_http(self, prompt, system_prompt, messages, kv_session):
+        agent = self.agent
+        if kv_session is not None:
+            key, request = agent._kv_request(prompt, system_prompt, kv_session, messages)
+            data = await self.ollama.generate(agent.model_name, options=agent.llm_options, **request)
+            kv_session.store_context(key, data.get('context'))
+            return data.get('response', '').strip()
+        
+        if messages:
+            data = await self.ollama.chat(agent.model_name, messages, options=agent.llm_options)
+            return data.get('message', {}).get('content', '').strip()
+        
+        data = await self.ollama.generate(agent.model_name, prompt, system=system_prompt,
+                                          options=agent.llm_options)
+        return data.get('response', '').strip()
+    
+    async def call_ollama(self, prompt, system_prompt=None, max_retries=3, messages=None, kv_session=None):
+        """Versión asíncrona de OpenSourceAgent.call_ollama (sin streaming)"""
+        agent = self.agent
+        cache_key = agent._response_cache_key(prompt, system_prompt, messages)
+        if cache_key:
+            cached = agent.response_cache.get(cache_key)
+            if cached is not None:
+                if kv_session is not None:
+                    kv_session.store_context(None, None)
+                return cached
+        
+        if self._llm_semaphore is None:
+            self._llm_semaphore = asyncio.Semaphore(self.max_concurrent_llm)
+        
+        await asyncio.to_thread(agent.wait_for_checks)
+        for attempt in range(max_retries):
+            try:
+                async with self._llm_semaphore:
+                    response = await agent.http_or_cli(
+                        lambda: self._call_ollama_http(prompt, system_prompt, messages, kv_session),
+                        lambda: asyncio.to_thread(agent._call_ollama_cli, prompt, system_prompt, messages))
+                
+                if cache_key:
+                    agent.response_cache.put(cache_key, response)
+                return response
+                
+            except (TimeoutError, subprocess.TimeoutExpired):
+                agent.print_message(f"Timeout en intento {attempt + 1}", "warning")
+            except Exception as e:
+                agent.print_message(f"Error en intento {attempt + 1}: {str(e)}", "warning")
+        
+        return "Error: No se pudo obtener respuesta después de varios intentos"
+    
+    async def ensure_internet(self):
+        return await asyncio.to_thread(self.agent.ensure_internet)
+    
+    async def web_search(self, query, max_results=5):
+        """Búsqueda web; DuckDuckGo es síncrono, así que se ejecuta en un hilo"""
+        return await asyncio.to_thread(self.agent.web_search, query, max_results)
+    
+    async def get_weather(self, city=""):
+        """Clima con HTTP asíncrono (o en un hilo si httpx no está instalado)"""
+        agent = self.agent
+        if not HTTPX_AVAILABLE:
+            return await asyncio.to_thread(agent.get_weather, city)
+        city = city or "auto"
+        cached = agent.cached_weather(city)
+        if cached:
+            return agent.weather_result(cached)
+        if not agent.weather_local and not await self.ensure_internet():
+            return "❌ Sin conexión a internet: no se puede consultar el clima"
+        
+        import httpx
+        try:
+            if self._http is None:
+                self._http = httpx.AsyncClient(timeout=WEATHER_TIMEOUT)
+            
+            response = await self._http.get(agent.weather_url(city))
+            if response.status_code == 200:
+                return agent.weather_result(agent.store_weather(city, agent.parse_weather(city, response.json())))
+            return f"❌ No se pudo obtener información del clima para: {city}"
+        except Exception as e:
+            return f"❌ Error al obtener clima: {str(e)}"
+    
+    async def get_weather_batch(self, cities):
+        """Clima de varias ciudades a la vez (resultados en el mismo orden)"""
+        key = self.agent._weather_key
+        unique = {key(city or "auto"): city or "auto" for city in reversed(cities)}
+        results = dict(zip(unique, await asyncio.gather(*(self.get_weather(city) for city in unique.values()))))
+        return [results[key(city or "auto")] for city in cities]
+    
+    async def _run_steps(self, steps):
+        """Versión asíncrona de OpenSourceAgent._run_steps"""
+        agent = self.agent
+        reply = None
+        while True:
+            try:
+                kind, request = steps.send(reply)
+            except StopIteration as done:
+                return done.value
+            
+            if kind == "model":
+                request.pop('on_token', None)
+                reply = await self.call_ollama(**request)
+            elif kind == "native":
+                try:
+                    reply = await asyncio.to_thread(agent.call_ollama_native, *request)
+                except ToolsNotSupportedError:
+                    reply = None
+            else:
+                reply = await agent.scheduler.amap(*request)
+    
+    async def run_tool(self, tool_name, *args):
+        """Ejecuta una herramienta sin bloquear el bucle de eventos"""
+        if tool_name == "weather":
+            return await self.get_weather(*args)
+        if tool_name == "web_search":
+            return await self.web_search(*args)
+        return await asyncio.to_thread(self.agent.tools[tool_name], *args)
+    
+    async def process_query(self, user_query, session_id="default"):
+        """Versión asíncrona de OpenSourceAgent.process_query para una sesión concreta
+        
+        Los turnos de una misma sesión se procesan en orden; sesiones
+        distintas avanzan en paralelo.
+        """
+        agent = self.agent
+        session = self.session(session_id)
+        
+        async with session.lock:
+            try:
+                if user_query.strip().startswith("USE_TOOL:"):
+                    return str(await asyncio.to_thread(agent.execute_direct_tool_command, user_query))
+                
+                plan = agent.plan_direct_tool(user_query)
+                if plan:
+                    tool_name, args = plan
+                    return str(agent.format_direct_result(tool_name, args, await self.run_tool(tool_name, *args)))
+                
+                # Mismos bucles ReAct que OpenSourceAgent.query_result
+                speculation = agent.start_speculation(user_query)
+                try:
+                    for steps in agent.react_loops(user_query, session.window, speculation=speculation):
+                        outcome = await self._run_steps(steps)
+                        if outcome is not None:
+                            break
+                finally:
+                    agent.finish_speculation(speculation)
+                
+                if isinstance(outcome, str):
+                    return outcome
+                
+                final_response, all_calls, steps = outcome
+                agent.log_steps(steps)
+                agent.record_turn(session.window, session.history, user_query, final_response, all_calls, steps)
+                return str(final_response)
+                
+            except Exception as e:
+                if agent.verbose:
+                    traceback.print_exc()
+                return f"❌ Error procesando consulta: {str(e)}"
+    
+    async def aclose(self):
+        """Libera las conexiones HTTP abiertas"""
+        self.agent.search_pool.close()
+        if self.agent.page_fetcher is not None:
+            self.agent.page_fetcher.close()
+        await self.ollama.aclose()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+def measure_import_time(module="agente_ia", runs=3):
+    """Mide el coste de importar el módulo con `python -X importtime`
+    
+    Returns:
+        (milisegundos acumulados del mejor intento, [(ms propios, módulo), ...] más costosos)
+    """
+    best_total, best_entries = None, []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=Path(__file__).resolve().parent,
+                                capture_output=True, text=True, timeout=60)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        
+        total, entries = None, []
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            entries.append((int(self_us) / 1000, name.strip()))
+            if name.strip() == module:
+                total = int(cumulative_us) / 1000
+        
+        if total is not None and (best_total is None or total < best_total):
+            best_total, best_entries = total, sorted(entries, reverse=True)[:5]
+    return best_total, best_entries
+
+def benchmark_startup(budget_ms=IMPORT_TIME_BUDGET_MS):
+    """Comprueba que importar el agente no supere el presupuesto de tiempo"""
+    total, heaviest = measure_import_time()
+    print(f"⏱️ import agente_ia: {total:.1f} ms (presupuesto: {budget_ms} ms)")
+    for ms, name in heaviest:
+        print(f"   {ms:8.1f} ms  {name}")
+    
+    if total > budget_ms:
+        print("❌ Se superó el presupuesto de tiempo de importación")
+        return False
+    print("✅ Dentro del presupuesto")
+    return True
+
 def main():
     """Función principal con manejo de argumentos"""
     import argparse
@@ -627,16 +3817,74 @@ def main():
     parser.add_argument("--model", default="llama3.2", help="Modelo de Ollama a usar")
     parser.add_argument("--verbose", action="store_true", help="Modo verbose")
     parser.add_argument("--query", help="Ejecutar una consulta única")
+    parser.add_argument("--host", help="URL de la API de Ollama (por defecto $OLLAMA_HOST)")
+    parser.add_argument("--no-stream", action="store_true", help="Mostrar la respuesta solo al terminar")
+    parser.add_argument("--fast-start", action="store_true", help="Omitir las verificaciones de arranque")
+    parser.add_argument("--num-ctx", type=int, default=DEFAULT_CONTEXT_LENGTH,
+                        help="Tamaño de contexto del modelo en tokens")
+    parser.add_argument("--no-kv-context", action="store_true",
+                        help="No reutilizar el contexto KV de Ollama entre turnos (usar /api/chat)")
+    parser.add_argument("--max-steps", type=int, default=MAX_AGENT_STEPS,
+                        help="Máximo de pasos modelo → herramientas → observación por consulta")
+    parser.add_argument("--tool-mode", choices=TOOL_MODES, default="text",
+                        help="Protocolo de herramientas: texto USE_TOOL, tool calling nativo de Ollama o automático")
+    parser.add_argument("--semantic-router", nargs="?", const=EMBED_MODEL, metavar="MODELO",
+                        help=f"Enrutar consultas por similitud de embeddings (por defecto {EMBED_MODEL}; "
+                             "'hash' = sin modelo, requiere numpy)")
+    parser.add_argument("--no-speculation", action="store_true",
+                        help="No adelantar búsquedas ni consultas del clima mientras el modelo genera")
+    parser.add_argument("--region", default=SEARCH_REGION,
+                        help="Región de DuckDuckGo para las búsquedas (wt-wt, es-es, mx-es, us-en...)")
+    parser.add_argument("--safesearch", choices=["on", "moderate", "off"], default=SEARCH_SAFESEARCH,
+                        help="Filtro de contenido de las búsquedas (duckduckgo_search 8.x no lo aplica "
+                             "a las búsquedas de texto: se envía por si una versión futura lo usa)")
+    parser.add_argument("--no-search-cache", action="store_true",
+                        help="No cachear los resultados de búsqueda")
+    parser.add_argument("--deep-search", nargs="?", type=int, const=DEEP_SEARCH_PAGES, default=0, metavar="N",
+                        help=f"Descargar las N primeras páginas de cada búsqueda y entregar al modelo "
+                             f"los extractos más relevantes (por defecto {DEEP_SEARCH_PAGES})")
+    parser.add_argument("--search-index", action="store_true",
+                        help="Indexar localmente lo que devuelven las búsquedas y consultarlo antes que la red")
+    parser.add_argument("--temperature", type=float, help="Temperatura de muestreo del modelo")
+    parser.add_argument("--seed", type=int, help="Semilla fija de muestreo")
+    parser.add_argument("--cache", action="store_true",
+                        help="Cachear en disco las respuestas del modelo (requiere --temperature 0 o --seed)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Desactivar la caché de respuestas aunque esté activada con AGENTE_CACHE=1")
+    parser.add_argument("--json", action="store_true",
+                        help="Con --query, imprimir el resultado estructurado en JSON")
+    parser.add_argument("--bench-startup", action="store_true",
+                        help="Medir el tiempo de importación frente al presupuesto y salir")
     
     args = parser.parse_args()
     
-    # Crear agente
-    agent = OpenSourceAgent(model_name=args.model, verbose=args.verbose)
+    if args.bench_startup:
+        sys.exit(0 if benchmark_startup() else 1)
+    
+    use_cache = (args.cache or os.environ.get("AGENTE_CACHE") == "1") and not args.no_cache
+    
+    # Crear agente (en modo consulta única las verificaciones no bloquean el arranque)
+    agent = OpenSourceAgent(model_name=args.model, verbose=args.verbose, ollama_host=args.host,
+                            stream=not args.no_stream, skip_checks=args.fast_start,
+                            background_checks=bool(args.query), context_length=args.num_ctx,
+                            kv_context=not args.no_kv_context, temperature=args.temperature,
+                            seed=args.seed, response_cache=use_cache, max_steps=args.max_steps,
+                            tool_mode=args.tool_mode, semantic_router=args.semantic_router,
+                            speculative=not args.no_speculation, search_region=args.region,
+                            safesearch=args.safesearch, search_cache=not args.no_search_cache,
+                            deep_search=args.deep_search, search_index=args.search_index)
     
     if args.query:
         # Modo consulta única
-        response = agent.process_query(args.query)
-        print(response)
+        if args.json:
+            # Datos estructurados de las herramientas, sin parsear el texto formateado;
+            # stdout queda solo para el JSON (los avisos y el progreso van a stderr)
+            with redirect_stdout(sys.stderr):
+                result = result_to_dict(agent.query_result(args.query))
+            print(json.dumps({"query": args.query, **result}, ensure_ascii=False, indent=2, default=str))
+        else:
+            response = agent.process_query(args.query)
+            print(response)
     else:
         # Modo interactivo
         agent.chat_loop()